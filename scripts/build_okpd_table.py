@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Сборка плоской таблицы ОКПД2 из JSON-дерева
+
+Запуск из корня проекта:
+    python -m scripts.build_okpd_table
+"""
+import argparse
+
+from src.data.okpd_tree import OKPD2_FULL_TREE_PATH, OKPD2_TABLE_PATH, OKPD2Table, build_table, read_tree
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build OKPD2 lookup table')
+    parser.add_argument('--source', default=OKPD2_FULL_TREE_PATH, help='OKPD2 tree JSON')
+    parser.add_argument('--output', default=OKPD2_TABLE_PATH, help='Output table file')
+    args = parser.parse_args()
+
+    table_bytes = build_table(read_tree(args.source))
+    table = OKPD2Table(table_bytes)
+
+    with open(args.output, 'wb') as f:
+        f.write(table_bytes)
+
+    print(f"Written {len(table)} codes ({len(table_bytes):,} bytes) to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
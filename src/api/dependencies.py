@@ -1,5 +1,7 @@
+import functools
 from fastapi import Depends, HTTPException, Header
 from typing import Optional
+from redis.asyncio import Redis
 
 from src.core.config import settings
 from src.storage.target_mongo import TargetMongoStore
@@ -15,4 +17,22 @@ async def verify_api_key(x_api_key: Optional[str] = Header(None)):
 
 async def get_target_store() -> TargetMongoStore:
     """Получить экземпляр TargetMongoStore"""
-    return TargetMongoStore(settings.target_mongodb_database)
\ No newline at end of file
+    return TargetMongoStore(settings.target_mongodb_database)
+
+# Таймауты Redis (секунды): недоступный Redis не должен останавливать миграцию
+REDIS_SOCKET_TIMEOUT = 5
+
+@functools.lru_cache(maxsize=1)
+def get_redis_client() -> Redis:
+    """Общий для процесса клиент Redis (подключение создается при первой команде)"""
+    return Redis.from_url(
+        settings.redis_url,
+        socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT
+    )
+
+async def close_redis_client():
+    """Закрыть общий клиент Redis, если он создавался (при остановке приложения)"""
+    if get_redis_client.cache_info().currsize:
+        await get_redis_client().close()
+        get_redis_client.cache_clear()
@@ -93,6 +93,7 @@ async def get_migration_status(
         "migrated_products": job["migrated_products"],
         "progress_percentage": progress_percentage,
         "last_processed_id": job.get("last_processed_id"),
+        "errors": job.get("errors", []),
         "created_at": job["created_at"],
         "updated_at": job.get("updated_at")
     }
@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException
 import logging
 
-from src.api.dependencies import verify_api_key
+from src.api.dependencies import get_redis_client, verify_api_key
 from src.storage.source_mongo import SourceMongoStore
 from src.storage.target_mongo import TargetMongoStore
 from src.services.product_migrator import ProductMigrator
@@ -73,10 +73,12 @@ async def start_migration(api_key: str = Depends(verify_api_key)):
             }
 
         # Создаем мигратор
+        # Redis: уведомление воркеров о новой задаче и события прогресса
         migrator = ProductMigrator(
             source_store,
             target_store,
-            settings.migration_batch_size
+            settings.migration_batch_size,
+            redis_client=get_redis_client()
         )
 
         # Запускаем миграцию
@@ -4,7 +4,7 @@ import logging
 import uuid
 
 from src.api.dependencies import verify_api_key
-from src.services.ai_client import AnthropicClient
+from src.services.ai_client import get_client
 from src.services.classifier import StageOneClassifier
 from src.services.classifier_stage2 import StageTwoClassifier
 from src.core.config import settings
@@ -70,10 +70,11 @@ async def classify_tender(
 
         logger.info(f"Found {len(items_to_classify)} items without OKPD2 codes")
 
-        # Инициализируем AI клиент
-        ai_client = AnthropicClient(
+        # Общий AI клиент процесса - пул соединений переиспользуется между запросами
+        ai_client = get_client(
             settings.anthropic_api_key,
-            settings.anthropic_model
+            settings.anthropic_model,
+            settings.proxy_url
         )
 
         # Создаем временный store-заглушку для классификаторов
@@ -146,9 +147,6 @@ async def classify_tender(
                         if internal_id not in stage2_result["results"]:
                             failed_count += 1
 
-        # Закрываем AI клиент
-        await ai_client.__aexit__(None, None, None)
-
         # Статистика
         already_classified = len(items) - len(items_to_classify)
 
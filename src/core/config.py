@@ -33,6 +33,8 @@ class Settings(BaseSettings):
 
     # Redis
     redis_url: str = "redis://localhost:6379"
+    # Размер пула соединений: pub/sub монитора, блокировки и публикация прогресса
+    redis_max_connections: int = 16
 
     # Anthropic
     anthropic_api_key: str
@@ -49,7 +51,11 @@ class Settings(BaseSettings):
 
     # Processing
     migration_batch_size: int = 1000
+    # Сколько батчей миграции записывается в целевую БД одновременно
+    migration_parallel_batches: int = 4
     classification_batch_size: int = 250
+    # Конвейер классификации: параллельные запросы к AI
+    classification_concurrency: int = 2
     max_workers: int = 1
 
     # Rate limit settings
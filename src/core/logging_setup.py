@@ -0,0 +1,38 @@
+import atexit
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_listener: Optional[QueueListener] = None
+
+
+def setup_logging(level: int = logging.INFO):
+    """
+    Настроить логирование воркеров
+
+    Записи попадают в очередь, а в stdout их пишет отдельный поток
+    QueueListener - вывод не блокирует event loop.
+    """
+    global _listener
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+
+    # Настраиваем только один раз на процесс
+    if _listener is not None:
+        return
+
+    log_queue = queue.SimpleQueue()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root_logger.handlers = [QueueHandler(log_queue)]
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
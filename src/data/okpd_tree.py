@@ -0,0 +1,182 @@
+import functools
+import logging
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import Dict, Iterator, List, Mapping, Tuple, Union
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# Путь к файлу с полным деревом ОКПД2
+OKPD2_FULL_TREE_PATH = "src/data/okpd2_full_tree.json"
+
+# Плоская таблица кодов, собирается scripts/build_okpd_table.py
+OKPD2_TABLE_PATH = "src/data/okpd2_table.bin"
+
+# Формат таблицы: заголовок, отсортированные коды фиксированной ширины,
+# смещения описаний (count + 1) и UTF-8 блок описаний
+TABLE_MAGIC = b"OKPD2T01"
+TABLE_HEADER = struct.Struct("<8sI")
+CODE_WIDTH = 12  # XX.XX.XX.XXX
+OFFSET = struct.Struct("<I")
+
+
+def read_tree(path: str = OKPD2_FULL_TREE_PATH) -> Dict[str, Dict[str, str]]:
+    """
+    Прочитать дерево ОКПД2 в формате {"XX": {"XX.XX.X": "Описание", ...}, ...}
+
+    Raises:
+        FileNotFoundError: если файл с деревом отсутствует
+    """
+    return orjson.loads(Path(path).read_bytes())
+
+
+def build_table(tree: Dict[str, Dict[str, str]]) -> bytes:
+    """Упаковать дерево ОКПД2 в плоскую таблицу (см. OKPD2Table)"""
+    entries = sorted(
+        (code.encode("ascii"), description.encode("utf-8"))
+        for class_data in tree.values()
+        for code, description in class_data.items()
+        if isinstance(description, str)
+    )
+
+    codes = bytearray()
+    offsets = bytearray()
+    blob = bytearray()
+
+    for code, description in entries:
+        if len(code) > CODE_WIDTH:
+            raise ValueError(f"OKPD2 code is too long: {code.decode()}")
+        codes += code.ljust(CODE_WIDTH, b"\0")
+        offsets += OFFSET.pack(len(blob))
+        blob += description
+    offsets += OFFSET.pack(len(blob))
+
+    return TABLE_HEADER.pack(TABLE_MAGIC, len(entries)) + bytes(codes) + bytes(offsets) + bytes(blob)
+
+
+class OKPD2Table(Mapping[str, str]):
+    """
+    Отображение код -> описание поверх плоской таблицы ОКПД2
+
+    Коды хранятся отсортированными в одном буфере, поиск - бинарный. Таблица
+    из файла отображается в память (mmap), поэтому воркеры на одном хосте
+    разделяют одну копию через page cache.
+    """
+
+    def __init__(self, buffer: Union[bytes, mmap.mmap]):
+        magic, count = TABLE_HEADER.unpack_from(buffer, 0)
+        if magic != TABLE_MAGIC:
+            raise ValueError("Invalid OKPD2 table format")
+
+        self._buffer = buffer
+        self._count = count
+        self._codes_start = TABLE_HEADER.size
+        self._offsets_start = self._codes_start + count * CODE_WIDTH
+        self._blob_start = self._offsets_start + (count + 1) * OFFSET.size
+
+    def _code_key(self, index: int) -> bytes:
+        start = self._codes_start + index * CODE_WIDTH
+        return self._buffer[start:start + CODE_WIDTH]
+
+    def _code_at(self, index: int) -> str:
+        return self._code_key(index).rstrip(b"\0").decode("ascii")
+
+    def _description_at(self, index: int) -> str:
+        position = self._offsets_start + index * OFFSET.size
+        (start,) = OFFSET.unpack_from(self._buffer, position)
+        (end,) = OFFSET.unpack_from(self._buffer, position + OFFSET.size)
+        return self._buffer[self._blob_start + start:self._blob_start + end].decode("utf-8")
+
+    def _bisect_left(self, key: bytes) -> int:
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._code_key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _find(self, code: str) -> int:
+        if not code.isascii() or len(code) > CODE_WIDTH:
+            return -1
+        key = code.encode("ascii").ljust(CODE_WIDTH, b"\0")
+        index = self._bisect_left(key)
+        if index < self._count and self._code_key(index) == key:
+            return index
+        return -1
+
+    def __getitem__(self, code: str) -> str:
+        index = self._find(code)
+        if index < 0:
+            raise KeyError(code)
+        return self._description_at(index)
+
+    def __contains__(self, code) -> bool:
+        return isinstance(code, str) and self._find(code) >= 0
+
+    def __iter__(self) -> Iterator[str]:
+        return (self._code_at(index) for index in range(self._count))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def prefix_items(self, prefix: str) -> Iterator[Tuple[str, str]]:
+        """Коды, начинающиеся с prefix, с описаниями - в порядке сортировки"""
+        if not prefix.isascii():
+            return
+        key = prefix.encode("ascii")
+        index = self._bisect_left(key)
+        while index < self._count and self._code_key(index).startswith(key):
+            yield self._code_at(index), self._description_at(index)
+            index += 1
+
+    def class_codes(self) -> List[str]:
+        """Список классов (первые две цифры кода)"""
+        classes = []
+        index = 0
+        while index < self._count:
+            class_code = self._code_at(index)[:2]
+            classes.append(class_code)
+            # Переходим к первому коду следующего класса
+            index = self._bisect_left(class_code.encode("ascii") + b"\xff")
+        return classes
+
+
+def _is_table_fresh() -> bool:
+    """Таблица есть и собрана не раньше JSON-дерева"""
+    if not os.path.exists(OKPD2_TABLE_PATH):
+        return False
+    if not os.path.exists(OKPD2_FULL_TREE_PATH):
+        return True
+    return os.path.getmtime(OKPD2_TABLE_PATH) >= os.path.getmtime(OKPD2_FULL_TREE_PATH)
+
+
+@functools.lru_cache(maxsize=1)
+def get_table() -> OKPD2Table:
+    """
+    Получить таблицу ОКПД2, общую для процесса
+
+    Собранная таблица отображается в память; если ее нет или она старше
+    JSON-дерева, таблица собирается из JSON в памяти процесса.
+
+    Raises:
+        FileNotFoundError: если нет ни таблицы, ни файла с деревом
+    """
+    if _is_table_fresh():
+        with open(OKPD2_TABLE_PATH, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        table = OKPD2Table(buffer)
+        logger.info(f"Mapped OKPD2 table from {OKPD2_TABLE_PATH} ({len(table)} codes)")
+        return table
+
+    table = OKPD2Table(build_table(read_tree()))
+    logger.warning(
+        f"OKPD2 table {OKPD2_TABLE_PATH} is missing or stale, built {len(table)} codes "
+        f"in process memory. Run 'make okpd-table' to share one mapped copy between workers"
+    )
+    return table
@@ -4,6 +4,8 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from src.api.router import router as api_router
+from src.api.dependencies import close_redis_client
+from src.services.ai_client import close_clients
 
 # Настройка логирования
 logging.basicConfig(
@@ -21,6 +23,8 @@ async def lifespan(app: FastAPI):
     yield
     # Shutdown
     logger.info("Shutting down application...")
+    await close_clients()
+    await close_redis_client()
 
 
 # Создание приложения
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import math
+import statistics
+import time
+from collections import deque
+from typing import Any, Mapping, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# Статусы, при которых API перегружен или ограничивает частоту запросов
+OVERLOAD_STATUSES = frozenset((429, 502, 529, "timeout", "reset"))
+
+
+class AIMDController:
+    """
+    Адаптивное ограничение параллельных запросов к Anthropic API (AIMD)
+
+    Пока задержка ответов в пределах цели, лимит растет на increase за каждый
+    ответ; при 429/529, таймаутах и превышении задержки лимит умножается на
+    decrease. Если API сообщает, что осталось меньше 10% запросов, лимит
+    сбрасывается до минимума и новые запросы ждут retry-after.
+    """
+
+    def __init__(
+            self,
+            min_limit: int = 1,
+            max_limit: int = 4,
+            increase: float = 0.5,
+            decrease: float = 0.5,
+            window: int = 50,
+            latency_target: Optional[float] = None
+    ):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+
+        self._limit = float(self.min_limit)
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+        self._latencies = deque(maxlen=window)
+        self._paused_until = 0.0
+        # Ссылки на задачи пробуждения, чтобы их не собрал сборщик мусора
+        self._notify_tasks = set()
+
+    @property
+    def limit(self) -> int:
+        """Текущий лимит параллельных запросов"""
+        return max(self.min_limit, math.floor(self._limit))
+
+    async def __aenter__(self):
+        # API попросил подождать - не отправляем запрос раньше времени.
+        # Пауза выдерживается до захвата слота: отмена во время паузы
+        # не оставляет занятый слот
+        pause = self._paused_until - time.monotonic()
+        while pause > 0:
+            await asyncio.sleep(pause)
+            pause = self._paused_until - time.monotonic()
+
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def record_success(self, latency: float, headers: Optional[Mapping[str, str]] = None):
+        """Учесть успешный ответ"""
+        self._latencies.append(latency)
+
+        # Цель по задержке - полуторная медиана первого полного окна
+        if self.latency_target is None and len(self._latencies) == self._latencies.maxlen:
+            self.latency_target = statistics.median(self._latencies) * 1.5
+            logger.info(f"AIMD latency target set to {self.latency_target:.1f}s")
+
+        if self._is_rate_limit_exhausted(headers):
+            self._throttle(headers)
+            return
+
+        mean_latency = statistics.fmean(self._latencies)
+        if self.latency_target is not None and mean_latency > self.latency_target:
+            self._decrease(f"mean latency {mean_latency:.1f}s > target {self.latency_target:.1f}s")
+        else:
+            self._set_limit(min(self.max_limit, self._limit + self.increase))
+
+    def record_failure(self, status: Union[int, str], headers: Optional[Mapping[str, str]] = None):
+        """Учесть ошибку запроса"""
+        if status in (429, 529):
+            self._throttle(headers)
+        elif status in OVERLOAD_STATUSES:
+            self._decrease(f"status {status}")
+
+    def _decrease(self, reason: str):
+        self._set_limit(max(self.min_limit, self._limit * self.decrease))
+        logger.warning(f"AIMD decrease ({reason}): concurrency limit {self.limit}")
+
+    def _throttle(self, headers: Optional[Mapping[str, str]]):
+        """Сбросить лимит до минимума и приостановить запросы на retry-after"""
+        self._set_limit(self.min_limit)
+
+        retry_after = self._parse_retry_after(headers)
+        if retry_after:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+        logger.warning(
+            f"AIMD throttled by API: concurrency limit {self.limit}, "
+            f"pause {retry_after or 0:.1f}s"
+        )
+
+    def _set_limit(self, value: float):
+        previous_limit = self.limit
+        self._limit = value
+
+        # При росте лимита будим ожидающие запросы
+        if self.limit > previous_limit:
+            task = asyncio.get_running_loop().create_task(self._notify())
+            self._notify_tasks.add(task)
+            task.add_done_callback(self._notify_tasks.discard)
+
+    async def _notify(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+    @staticmethod
+    def _is_rate_limit_exhausted(headers: Optional[Mapping[str, str]]) -> bool:
+        if not headers:
+            return False
+        try:
+            remaining = int(headers["anthropic-ratelimit-requests-remaining"])
+            limit = int(headers["anthropic-ratelimit-requests-limit"])
+        except (KeyError, TypeError, ValueError):
+            return False
+        return limit > 0 and remaining < limit * 0.1
+
+    @staticmethod
+    def _parse_retry_after(headers: Optional[Mapping[str, Any]]) -> Optional[float]:
+        if not headers:
+            return None
+        try:
+            return float(headers["retry-after"])
+        except (KeyError, TypeError, ValueError):
+            return None
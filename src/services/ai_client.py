@@ -1,50 +1,63 @@
-from anthropic import AsyncAnthropic
+from anthropic import AsyncAnthropic, APIConnectionError, APIStatusError, APITimeoutError
 from typing import List, Dict, Any, Optional
 import logging
 import re
+import time
 import httpx
 import os
 from src.core.config import settings
+from src.services.admission import AIMDController
 
 logger = logging.getLogger(__name__)
 
 
+# Пул соединений с API: держим keep-alive соединения между батчами
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=64, keepalive_expiry=120)
+
+
 class AnthropicClient:
-    def __init__(self, api_key: str, model: str):
-        self.proxy_url = settings.proxy_url
+    def __init__(
+            self,
+            api_key: str,
+            model: str,
+            admission: Optional[AIMDController] = None,
+            proxy_url: Optional[str] = None
+    ):
+        self.proxy_url = proxy_url or settings.proxy_url
         self.api_key = api_key
         self.model = model
         self.client = None
         self._http_client = None
         self.enable_caching = settings.enable_prompt_caching
+        # Адаптивное ограничение параллельных запросов (опционально)
+        self.admission = admission
 
     async def _ensure_client(self):
         """Создать клиент при необходимости"""
         if self.client is None:
             if self.proxy_url:
                 logger.info(f"Using proxy for Anthropic API: {self.proxy_url}")
-                # УВЕЛИЧИВАЕМ ТАЙМАУТЫ для больших запросов
-                self._http_client = httpx.AsyncClient(
-                    proxy=self.proxy_url,
-                    timeout=httpx.Timeout(
-                        timeout=300.0,      # Общий таймаут 5 минут
-                        connect=30.0,       # Таймаут подключения 30 секунд
-                        read=300.0,         # Таймаут чтения 5 минут
-                        write=30.0          # Таймаут записи 30 секунд
-                    )
-                )
-                self.client = AsyncAnthropic(
-                    api_key=self.api_key,
-                    http_client=self._http_client,
-                    # Также увеличиваем таймаут в самом клиенте
-                    timeout=300.0
-                )
             else:
                 logger.info("No proxy configured for Anthropic API")
-                self.client = AsyncAnthropic(
-                    api_key=self.api_key,
-                    timeout=300.0  # Увеличиваем таймаут
+
+            # УВЕЛИЧИВАЕМ ТАЙМАУТЫ для больших запросов
+            self._http_client = httpx.AsyncClient(
+                proxy=self.proxy_url,
+                http2=True,
+                limits=HTTP_LIMITS,
+                timeout=httpx.Timeout(
+                    timeout=300.0,      # Общий таймаут 5 минут
+                    connect=30.0,       # Таймаут подключения 30 секунд
+                    read=300.0,         # Таймаут чтения 5 минут
+                    write=30.0          # Таймаут записи 30 секунд
                 )
+            )
+            self.client = AsyncAnthropic(
+                api_key=self.api_key,
+                http_client=self._http_client,
+                # Также увеличиваем таймаут в самом клиенте
+                timeout=300.0
+            )
 
     async def classify_batch(self, prompt: str, cached_content: str = None, max_tokens: int = 4000) -> str:
         """Отправить запрос на классификацию с поддержкой кэширования"""
@@ -79,9 +92,9 @@ class AnthropicClient:
 
             # Логируем размер запроса
             total_content_size = len(str(messages))
-            logger.info(f"Sending request with total content size: {total_content_size:,} chars")
+            logger.info("Sending request with total content size: %d chars", total_content_size)
 
-            response = await self.client.messages.create(
+            response = await self._create_message(
                 model=self.model,
                 max_tokens=max_tokens,
                 messages=messages,
@@ -93,10 +106,10 @@ class AnthropicClient:
             if hasattr(response, 'usage'):
                 usage = response.usage
                 if hasattr(usage, 'cache_creation_input_tokens'):
-                    logger.info(f"Cache creation tokens: {usage.cache_creation_input_tokens}")
+                    logger.info("Cache creation tokens: %s", usage.cache_creation_input_tokens)
                 if hasattr(usage, 'cache_read_input_tokens'):
-                    logger.info(f"Cache read tokens: {usage.cache_read_input_tokens}")
-                logger.info(f"Total input tokens: {usage.input_tokens}")
+                    logger.info("Cache read tokens: %s", usage.cache_read_input_tokens)
+                logger.info("Total input tokens: %s", usage.input_tokens)
 
             return response.content[0].text
 
@@ -116,16 +129,79 @@ class AnthropicClient:
             logger.error(f"Error calling Anthropic API: {e}")
             raise
 
+    async def _create_message(self, **kwargs):
+        """Отправить запрос к API с учетом адаптивного лимита параллельности"""
+        if self.admission is None:
+            return await self.client.messages.create(**kwargs)
+
+        async with self.admission:
+            start_time = time.monotonic()
+            try:
+                raw_response = await self.client.messages.with_raw_response.create(**kwargs)
+            except APIStatusError as e:
+                self.admission.record_failure(e.status_code, e.response.headers)
+                raise
+            except APITimeoutError:
+                self.admission.record_failure("timeout")
+                raise
+            except APIConnectionError:
+                self.admission.record_failure("reset")
+                raise
+
+            self.admission.record_success(time.monotonic() - start_time, raw_response.headers)
+            return raw_response.parse()
+
     async def __aenter__(self):
         await self._ensure_client()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """Закрыть клиент при выходе из контекста"""
-        if self.client:
-            await self.client.close()
-        if self._http_client:
-            await self._http_client.aclose()
+        await self.close()
+
+    async def close(self):
+        """Закрыть клиент; следующий запрос откроет новый пул соединений"""
+        client, http_client = self.client, self._http_client
+        self.client = None
+        self._http_client = None
+
+        if client:
+            await client.close()
+        if http_client:
+            await http_client.aclose()
+
+
+# Общие клиенты процесса: параметры get_client -> клиент
+_clients: Dict[tuple, AnthropicClient] = {}
+
+
+def get_client(
+        api_key: str,
+        model: str,
+        proxy_url: Optional[str] = None,
+        max_concurrency: Optional[int] = None
+) -> AnthropicClient:
+    """
+    Получить общий для процесса клиент Anthropic
+
+    Клиенты с одинаковыми параметрами переиспользуют пул соединений, поэтому
+    TLS-рукопожатие и туннель через прокси устанавливаются один раз.
+    max_concurrency включает адаптивное ограничение параллельных запросов.
+    """
+    key = (api_key, model, proxy_url, max_concurrency)
+    if key not in _clients:
+        admission = AIMDController(max_limit=max_concurrency) if max_concurrency else None
+        _clients[key] = AnthropicClient(api_key, model, admission=admission, proxy_url=proxy_url)
+    return _clients[key]
+
+
+async def close_clients():
+    """Закрыть общие клиенты процесса (при остановке приложения)"""
+    clients = list(_clients.values())
+    _clients.clear()
+
+    for client in clients:
+        await client.close()
 
 
 class PromptBuilder:
@@ -258,7 +334,7 @@ class PromptBuilder:
                 if groups:
                     # Сохраняем порядок (первая группа - самая релевантная)
                     results[product_id] = groups
-                    logger.debug(f"Product '{product_name}' classified with top groups: {groups}")
+                    logger.debug("Product '%s' classified with top groups: %s", product_name, groups)
                 else:
                     logger.warning(f"No valid groups found for product '{product_name}'")
 
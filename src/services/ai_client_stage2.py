@@ -1,9 +1,9 @@
 import logging
 import re
-import json
-import os
 from typing import List, Dict, Any, Optional, Set
 
+from src.data.okpd_tree import OKPD2_FULL_TREE_PATH, OKPD2Table, build_table, get_table
+
 logger = logging.getLogger(__name__)
 
 
@@ -11,7 +11,7 @@ class PromptBuilderStage2:
     """Построитель промптов для второго этапа классификации с кэшированием"""
 
     # Путь к файлу с полным деревом ОКПД2
-    OKPD2_FULL_TREE_PATH = "src/data/okpd2_full_tree.json"
+    OKPD2_FULL_TREE_PATH = OKPD2_FULL_TREE_PATH
 
     def __init__(self):
         self._okpd2_tree = None
@@ -21,20 +21,18 @@ class PromptBuilderStage2:
     def _load_resources(self):
         """Загрузить дерево ОКПД2"""
         try:
-            if os.path.exists(self.OKPD2_FULL_TREE_PATH):
-                with open(self.OKPD2_FULL_TREE_PATH, 'r', encoding='utf-8') as f:
-                    self._okpd2_tree = json.load(f)
-                logger.info(f"Loaded OKPD2 tree from {self.OKPD2_FULL_TREE_PATH}")
-
-                # Создаем кэши для каждого класса
-                self._prepare_class_caches()
-            else:
-                logger.warning(f"OKPD2 tree file not found at {self.OKPD2_FULL_TREE_PATH}")
-                logger.warning("Please create this file with the full OKPD2 hierarchy")
-                self._okpd2_tree = {}
+            # Таблица кодов загружается один раз на процесс и разделяется между экземплярами
+            self._okpd2_tree = get_table()
+
+            # Создаем кэши для каждого класса
+            self._prepare_class_caches()
+        except FileNotFoundError:
+            logger.warning(f"OKPD2 tree file not found at {self.OKPD2_FULL_TREE_PATH}")
+            logger.warning("Please create this file with the full OKPD2 hierarchy")
+            self._okpd2_tree = OKPD2Table(build_table({}))
         except Exception as e:
             logger.error(f"Failed to load OKPD2 tree: {e}")
-            self._okpd2_tree = {}
+            self._okpd2_tree = OKPD2Table(build_table({}))
 
     def _prepare_class_caches(self):
         """Подготовить кэшированный контент для каждого класса"""
@@ -83,13 +81,14 @@ class PromptBuilderStage2:
 """
 
         # Для каждого класса создаем кэшированный контент
-        for class_code, class_data in self._okpd2_tree.items():
+        for class_code in self._okpd2_tree.class_codes():
+            class_data = dict(self._okpd2_tree.prefix_items(class_code))
             codes_text = self._format_class_codes(class_code, class_data)
             self._class_caches[class_code] = base_prompt + f"\nДОСТУПНЫЕ КОДЫ КЛАССА {class_code}:\n{codes_text}"
 
             # Логируем размер кэша
             cache_size = len(self._class_caches[class_code])
-            logger.debug(f"Cache for class {class_code}: {cache_size:,} chars")
+            logger.debug("Cache for class %s: %d chars", class_code, cache_size)
 
     def _format_class_codes(self, class_code: str, class_data: Dict[str, str]) -> str:
         """Форматировать коды класса для кэша"""
@@ -160,14 +159,9 @@ class PromptBuilderStage2:
         # Если несколько классов - объединяем коды
         # (это менее эффективно, но редкий случай)
         all_codes = {}
-        for class_code in classes:
-            if class_code in self._okpd2_tree:
-                class_data = self._okpd2_tree[class_code]
-                for group in okpd_groups:
-                    if group.startswith(class_code):
-                        for code, desc in class_data.items():
-                            if code.startswith(group) and isinstance(desc, str):
-                                all_codes[code] = desc
+        for group in okpd_groups:
+            if group and len(group) >= 2:
+                all_codes.update(self._okpd2_tree.prefix_items(group))
 
         if not all_codes:
             return None
@@ -241,7 +235,7 @@ class PromptBuilderStage2:
                     "code": code,
                     "name": product_name
                 }
-                logger.debug(f"Product '{product_name}' classified with code: {code}")
+                logger.debug("Product '%s' classified with code: %s", product_name, code)
             else:
                 logger.warning(f"Product '{product_name}' not found in mapping")
 
@@ -252,16 +246,4 @@ class PromptBuilderStage2:
         if not self._okpd2_tree:
             return None
 
-        # Получаем класс
-        okpd_class = code[:2]
-
-        if okpd_class not in self._okpd2_tree:
-            return None
-
-        class_data = self._okpd2_tree[okpd_class]
-
-        # Проверяем, есть ли код в словаре класса
-        if code in class_data and isinstance(class_data[code], str):
-            return class_data[code]
-
-        return None
\ No newline at end of file
+        return self._okpd2_tree.get(code)
\ No newline at end of file
@@ -1,12 +1,13 @@
 import uuid
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from datetime import datetime
 import asyncio
 import os
 import time
 
 from src.services.ai_client import AnthropicClient, PromptBuilder
+from src.storage.bulk_processor import BulkProcessor
 from src.storage.target_mongo import TargetMongoStore
 from src.models.domain import ProductStatus
 
@@ -22,13 +23,18 @@ class StageOneClassifier:
             target_store: TargetMongoStore,
             batch_size: int = 300,
             worker_id: str = None,
-            collection_name: str = None
+            collection_name: str = None,
+            shard_buckets: Optional[List[int]] = None,
+            bulk_processor: Optional[BulkProcessor] = None
     ):
         self.ai_client = ai_client
         self.target_store = target_store
         self.batch_size = batch_size
         self.worker_id = worker_id or f"worker_{uuid.uuid4().hex[:8]}"
         self.collection_name = collection_name
+        self.shard_buckets = shard_buckets
+        # Буфер записи результатов (None - пишем в БД сразу)
+        self.bulk_processor = bulk_processor
         self.prompt_builder = PromptBuilder()
 
         # Получаем кэшируемый контент один раз
@@ -43,6 +49,8 @@ class StageOneClassifier:
         self.last_cache_refresh = time.time()
         self.cache_refresh_interval = 240  # 4 минуты
 
+        self._current_batch_size = batch_size
+
         logger.info(f"Classifier initialized with batch_size={batch_size}, "
                     f"rate_limit_delay={self.rate_limit_delay}s, "
                     f"max_retries={self.max_retries}")
@@ -60,7 +68,7 @@ class StageOneClassifier:
             }
 
         batch_id = f"batch_{uuid.uuid4().hex[:8]}"
-        logger.info(f"Processing batch {batch_id} with {len(products)} products")
+        logger.info("Processing batch %s with %d products", batch_id, len(products))
 
         start_time = time.time()
         product_ids = [p["_id"] for p in products]
@@ -106,7 +114,7 @@ class StageOneClassifier:
                 )
 
                 processing_time = time.time() - start_time
-                logger.info(f"Batch processing time: {processing_time:.2f}s")
+                logger.info("Batch processing time: %.2fs", processing_time)
 
                 return {
                     "batch_id": batch_id,
@@ -231,7 +239,7 @@ class StageOneClassifier:
                         "worker_id": self.worker_id
                     }
                 })
-                logger.debug(f"Product {product_id} classified with groups: {results[product_id]}")
+                logger.debug("Product %s classified with groups: %s", product_id, results[product_id])
             else:
                 # Товар не классифицирован
                 updates.append({
@@ -241,10 +249,9 @@ class StageOneClassifier:
                         "worker_id": self.worker_id
                     }
                 })
-                logger.debug(f"Product {product_id} not classified")
+                logger.debug("Product %s not classified", product_id)
 
-        if updates:
-            await self.target_store.bulk_update_products(updates)
+        await self._write_updates(updates)
 
     async def _mark_products_failed(self, product_ids: List[Any]):
         """Пометить товары как failed"""
@@ -258,45 +265,150 @@ class StageOneClassifier:
                 }
             })
 
-        if updates:
-            await self.target_store.bulk_update_products(updates)
+        await self._write_updates(updates)
+
+    async def _write_updates(self, updates: List[Dict[str, Any]]):
+        """Записать обновления в БД или добавить их в буфер записи"""
+        if not updates:
+            return
 
-    async def run_continuous_classification(self):
-        """Запустить непрерывную классификацию"""
-        logger.info(f"Starting continuous classification for worker {self.worker_id}...")
-        logger.info(f"Using prompt caching with Claude 3.5 Sonnet")
+        if self.bulk_processor is not None:
+            await self.bulk_processor.enqueue(*self.target_store.build_update_operations(updates))
+        else:
+            await self.target_store.bulk_update_products(updates)
 
+    async def run_pipelined_classification(self, concurrency: int = 2):
+        """
+        Запустить непрерывную классификацию в конвейерном режиме
+
+        concurrency обработчиков классифицируют батчи параллельно. Продюсер
+        захватывает батч, только когда обработчик освободился, поэтому в
+        processing не бывает больше concurrency батчей и товары не ждут паузы
+        rate_limit_delay. Результаты объединяются в общие bulk-записи, если
+        классификатору передан bulk_processor.
+        """
+        logger.info(
+            f"Starting pipelined classification for worker {self.worker_id}: "
+            f"concurrency={concurrency}"
+        )
+
+        # Размер очереди ограничен числом свободных обработчиков (demand)
+        claimed_queue: asyncio.Queue = asyncio.Queue()
+        # Свободные обработчики: батч захватывается только под готового
+        # обработчика, а не на время его паузы rate_limit_delay
+        demand = asyncio.Semaphore(0)
+        self._current_batch_size = self.batch_size
+        # Незавершенный захват продюсера
+        self._claim_task: Optional[asyncio.Future] = None
+
+        tasks = [asyncio.create_task(self._claim_producer(claimed_queue, demand))]
+        tasks.extend(
+            asyncio.create_task(self._classify_consumer(claimed_queue, demand))
+            for _ in range(max(1, concurrency))
+        )
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            # Возвращаем захваченные, но не взятые в обработку батчи в очередь,
+            # включая батч, который продюсер захватывал в момент остановки
+            queued_products = []
+            while not claimed_queue.empty():
+                queued_products.extend(claimed_queue.get_nowait())
+
+            if self._claim_task is not None:
+                try:
+                    queued_products.extend(await self._claim_task)
+                except Exception as e:
+                    logger.error(f"Error claiming products for worker {self.worker_id}: {e}")
+                self._claim_task = None
+
+            await self._release_claimed_products(queued_products)
+
+    async def _release_claimed_products(self, products: List[Dict[str, Any]]):
+        """Вернуть захваченные, но не классифицированные товары в pending"""
+        if not products:
+            return
+
+        released_updates = [
+            {"_id": product["_id"], "data": {"status_stage1": ProductStatus.PENDING.value}}
+            for product in products
+        ]
+        try:
+            await self.target_store.bulk_update_products(released_updates)
+            logger.info("Worker %s: released %d claimed products", self.worker_id, len(products))
+        except Exception as e:
+            logger.error(f"Failed to release claimed products on shutdown: {e}")
+
+    async def _claim_producer(self, claimed_queue: asyncio.Queue, demand: asyncio.Semaphore):
+        """Захватывать батчи pending товаров для свободных обработчиков"""
         first_batch = True
-        consecutive_timeouts = 0
-        current_batch_size = self.batch_size
 
         while True:
-            batch_size = 1 if first_batch else current_batch_size
-
+            await demand.acquire()
+
+            # Первый батч из одного товара прогревает кэш промпта
+            batch_size = 1 if first_batch else self._current_batch_size
+
+            # Захват - серия find_one_and_update; при остановке он не прерывается
+            # посередине, захваченное возвращает run_pipelined_classification
+            self._claim_task = asyncio.ensure_future(self.target_store.get_pending_products_atomic(
+                batch_size,
+                self.worker_id,
+                self.collection_name,
+                self.shard_buckets
+            ))
             try:
-                # Получаем pending товары атомарно
-                products = await self.target_store.get_pending_products_atomic(
-                    batch_size,
-                    self.worker_id
-                )
+                products = await asyncio.shield(self._claim_task)
+                self._claim_task = None
+            except Exception as e:
+                self._claim_task = None
+                demand.release()
+                logger.error(f"Error claiming products for worker {self.worker_id}: {e}", exc_info=True)
+                await asyncio.sleep(30)
+                continue
+
+            if not products:
+                demand.release()
+                logger.info(f"Worker {self.worker_id}: No pending products, waiting...")
+                await asyncio.sleep(10)
+
+                # Обновляем кэш даже во время простоя
+                await self._refresh_cache_if_needed()
+                self._current_batch_size = self.batch_size
+                continue
+
+            claimed_queue.put_nowait(products)
+
+            if first_batch:
+                # Ждем, пока первый батч будет обработан и кэш создан
+                await claimed_queue.join()
                 first_batch = False
 
-                if not products:
-                    logger.info(f"Worker {self.worker_id}: No pending products, waiting...")
-                    await asyncio.sleep(10)
-
-                    # Обновляем кэш даже во время простоя
-                    await self._refresh_cache_if_needed()
-
-                    # Сбрасываем счетчик таймаутов при простое
-                    consecutive_timeouts = 0
-                    current_batch_size = self.batch_size
-                    continue
+    async def _classify_consumer(self, claimed_queue: asyncio.Queue, demand: asyncio.Semaphore):
+        """Классифицировать захваченные батчи"""
+        consecutive_timeouts = 0
 
-                logger.info(f"Worker {self.worker_id}: Got {len(products)} products to process")
+        while True:
+            demand.release()
+            products = await claimed_queue.get()
 
-                # Обрабатываем батч
-                result = await self.process_batch(products)
+            try:
+                logger.info("Worker %s: Got %d products to process", self.worker_id, len(products))
+
+                try:
+                    result = await self.process_batch(products)
+                except asyncio.CancelledError:
+                    # Остановка посреди обработки: результаты не записаны,
+                    # возвращаем батч в pending
+                    await self._release_claimed_products(products)
+                    raise
+                finally:
+                    claimed_queue.task_done()
 
                 logger.info(
                     f"Worker {self.worker_id}: Batch processed - "
@@ -304,39 +416,33 @@ class StageOneClassifier:
                     f"not classified: {result['none_classified']}"
                 )
 
-                # Успешная обработка - сбрасываем счетчик таймаутов
                 consecutive_timeouts = 0
 
                 # Постепенно увеличиваем размер батча после успешной обработки
-                if current_batch_size < self.batch_size:
-                    current_batch_size = min(current_batch_size * 2, self.batch_size)
-                    logger.info(f"Increasing batch size to {current_batch_size}")
+                if self._current_batch_size < self.batch_size:
+                    self._current_batch_size = min(self._current_batch_size * 2, self.batch_size)
+                    logger.info("Increasing batch size to %d", self._current_batch_size)
 
-                # Задержка между батчами
-                logger.info(f"Worker {self.worker_id}: Waiting {self.rate_limit_delay}s before next batch...")
                 await asyncio.sleep(self.rate_limit_delay)
 
             except Exception as e:
                 error_str = str(e).lower()
 
-                # Особая обработка таймаутов
                 if "timeout" in error_str or "timed out" in error_str:
                     consecutive_timeouts += 1
 
-                    # Уменьшаем размер батча при частых таймаутах
                     if consecutive_timeouts >= 2:
-                        current_batch_size = max(10, current_batch_size // 2)
+                        self._current_batch_size = max(10, self._current_batch_size // 2)
                         logger.warning(
-                            f"Multiple timeouts detected. Reducing batch size to {current_batch_size}"
+                            f"Multiple timeouts detected. Reducing batch size to {self._current_batch_size}"
                         )
 
-                    # Увеличиваем задержку при таймаутах
                     timeout_delay = min(300, 30 * consecutive_timeouts)
                     logger.error(
-                        f"Timeout error in continuous classification. "
+                        f"Timeout error in pipelined classification. "
                         f"Waiting {timeout_delay}s before retry..."
                     )
                     await asyncio.sleep(timeout_delay)
                 else:
-                    logger.error(f"Error in continuous classification for worker {self.worker_id}: {e}", exc_info=True)
-                    await asyncio.sleep(30)
\ No newline at end of file
+                    logger.error(f"Error in pipelined classification for worker {self.worker_id}: {e}", exc_info=True)
+                    await asyncio.sleep(30)
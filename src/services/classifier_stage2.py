@@ -8,6 +8,7 @@ import os
 
 from src.services.ai_client import AnthropicClient
 from src.services.ai_client_stage2 import PromptBuilderStage2
+from src.storage.bulk_processor import BulkProcessor
 from src.storage.target_mongo import TargetMongoStore
 from src.models.domain import ProductStatus
 
@@ -22,12 +23,15 @@ class StageTwoClassifier:
             ai_client: AnthropicClient,
             target_store: TargetMongoStore,
             batch_size: int = 50,
-            worker_id: str = None
+            worker_id: str = None,
+            bulk_processor: Optional[BulkProcessor] = None
     ):
         self.ai_client = ai_client
         self.target_store = target_store
         self.batch_size = batch_size
         self.worker_id = worker_id or f"stage2_worker_{uuid.uuid4().hex[:8]}"
+        # Буфер записи результатов (None - пишем в БД сразу)
+        self.bulk_processor = bulk_processor
         self.prompt_builder = PromptBuilderStage2()
 
         # Rate limit settings
@@ -53,7 +57,7 @@ class StageTwoClassifier:
             }
 
         batch_id = f"s2_batch_{uuid.uuid4().hex[:8]}"
-        logger.info(f"Processing stage 2 batch {batch_id} with {len(products)} products")
+        logger.info("Processing stage 2 batch %s with %d products", batch_id, len(products))
 
         start_time = time.time()
         product_ids = [p["_id"] for p in products]
@@ -64,7 +68,7 @@ class StageTwoClassifier:
         all_results = {}
 
         for class_code, class_products in products_by_class.items():
-            logger.info(f"Processing {len(class_products)} products for class {class_code}")
+            logger.info("Processing %d products for class %s", len(class_products), class_code)
 
             # Обновляем кэш для класса при необходимости
             await self._refresh_class_cache_if_needed(class_code)
@@ -136,7 +140,7 @@ class StageTwoClassifier:
         )
 
         processing_time = time.time() - start_time
-        logger.info(f"Batch processing time: {processing_time:.2f}s")
+        logger.info("Batch processing time: %.2fs", processing_time)
 
         return {
             "batch_id": batch_id,
@@ -213,7 +217,7 @@ class StageTwoClassifier:
                         "worker_id": self.worker_id
                     }
                 })
-                logger.debug(f"Product {product_id} classified with exact code: {code}")
+                logger.debug("Product %s classified with exact code: %s", product_id, code)
             else:
                 # Товар не классифицирован - точный код не найден
                 updates.append({
@@ -223,10 +227,9 @@ class StageTwoClassifier:
                         "worker_id": self.worker_id
                     }
                 })
-                logger.debug(f"Product {product_id} not classified in stage 2")
+                logger.debug("Product %s not classified in stage 2", product_id)
 
-        if updates:
-            await self.target_store.bulk_update_products(updates)
+        await self._write_updates(updates)
 
     async def _mark_products_failed(self, product_ids: List[Any]):
         """Пометить товары как failed для второго этапа"""
@@ -241,42 +244,21 @@ class StageTwoClassifier:
                 }
             })
 
-        if updates:
+        await self._write_updates(updates)
+
+    async def _write_updates(self, updates: List[Dict[str, Any]]):
+        """Записать обновления в БД или добавить их в буфер записи"""
+        if not updates:
+            return
+
+        if self.bulk_processor is not None:
+            await self.bulk_processor.enqueue(*self.target_store.build_update_operations(updates))
+        else:
             await self.target_store.bulk_update_products(updates)
 
     async def get_pending_products_batch(self, limit: int) -> List[Dict[str, Any]]:
         """Получить батч pending товаров для второго этапа"""
-        products = []
-
-        # Атомарно получаем и блокируем товары
-        for _ in range(limit):
-            doc = await self.target_store.products.find_one_and_update(
-                {
-                    "status_stage1": ProductStatus.CLASSIFIED.value,
-                    "okpd_groups": {"$exists": True, "$ne": []},
-                    "$or": [
-                        {"status_stage2": {"$exists": False}},
-                        {"status_stage2": ProductStatus.PENDING.value}
-                    ]
-                },
-                {
-                    "$set": {
-                        "status_stage2": ProductStatus.PROCESSING.value,
-                        "worker_id": self.worker_id
-                    }
-                },
-                return_document=True
-            )
-
-            if doc:
-                products.append(doc)
-            else:
-                break
-
-        if products:
-            logger.info(f"Locked {len(products)} products for stage 2 processing")
-
-        return products
+        return await self.target_store.get_pending_products_stage2_atomic(limit, self.worker_id)
 
     async def run_continuous_classification(self):
         """Запустить непрерывную классификацию второго этапа"""
@@ -293,7 +275,7 @@ class StageTwoClassifier:
                     await asyncio.sleep(10)
                     continue
 
-                logger.info(f"Worker {self.worker_id}: Got {len(products)} products for stage 2")
+                logger.info("Worker %s: Got %d products for stage 2", self.worker_id, len(products))
 
                 # Обрабатываем батч
                 result = await self.process_batch(products)
@@ -1,6 +1,7 @@
 import uuid
+import json
 import logging
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 import asyncio
 import time
 from datetime import datetime
@@ -11,6 +12,21 @@ from src.core.config import settings
 
 logger = logging.getLogger(__name__)
 
+# Если запись батча дольше порога - целевая БД перегружена, притормаживаем
+SLOW_BATCH_WRITE_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 1.0
+
+
+# Redis очередь уведомлений о новых задачах миграции для воркеров
+MIGRATION_TASKS_QUEUE = "migration:tasks:queue"
+# Уведомления нужны только для пробуждения - старые отбрасываем, если их не читают
+MIGRATION_TASKS_QUEUE_MAX_LENGTH = 100
+
+
+def get_migration_channel(job_id: str) -> str:
+    """Redis канал с событиями прогресса миграции"""
+    return f"migration:{job_id}"
+
 
 class ProductMigrator:
     """Сервис миграции товаров из исходной БД в целевую"""
@@ -19,11 +35,26 @@ class ProductMigrator:
             self,
             source_store: SourceMongoStore,
             target_store: TargetMongoStore,
-            batch_size: int = 1000
+            batch_size: int = 1000,
+            redis_client=None,
+            parallel_batches: Optional[int] = None,
+            notify_workers: bool = True
     ):
         self.source_store = source_store
         self.target_store = target_store
         self.batch_size = batch_size
+        # Ограничение числа батчей, записываемых одновременно
+        self.parallel_batches = max(1, parallel_batches or settings.migration_parallel_batches)
+        # Опционально: публикация прогресса для воркера миграции
+        self.redis_client = redis_client
+        # Будить воркеры миграции о новой задаче (не нужно, если мигрирует сам воркер)
+        self.notify_workers = notify_workers
+        # Промежуточный прогресс публикуется не чаще раза в интервал
+        self.progress_publish_interval = 0.5
+        self._last_progress_publish = 0.0
+        # После ошибки Redis промежуточный прогресс не публикуется до этого момента
+        self.publish_retry_interval = 30.0
+        self._publish_paused_until = 0.0
 
     async def start_migration(self, job_id: Optional[str] = None) -> str:
         """
@@ -38,17 +69,26 @@ class ProductMigrator:
         logger.info(f"Starting migration job {job_id}")
 
         try:
-            # Проверяем подключения
+            # Проверяем подключения к обеим БД и одновременно считаем товары
+            # во всех коллекциях (оценка по метаданным коллекций)
             logger.info("Verifying database connections...")
 
-            if not await self.source_store.test_connection():
+            source_ok, target_ok, collection_counts = await asyncio.gather(
+                self.source_store.test_connection(),
+                self.target_store.test_connection(),
+                self.source_store.count_all_products(),
+                return_exceptions=True
+            )
+
+            if source_ok is not True:
                 raise Exception("Cannot connect to source MongoDB")
 
-            if not await self.target_store.test_connection():
+            if target_ok is not True:
                 raise Exception("Cannot connect to target MongoDB")
 
-            # Получаем список всех коллекций и считаем товары
-            collection_counts = await self.source_store.count_all_products()
+            if isinstance(collection_counts, Exception):
+                raise collection_counts
+
             total_products = sum(collection_counts.values())
 
             logger.info(f"Total products to migrate: {total_products}")
@@ -58,11 +98,12 @@ class ProductMigrator:
                 logger.warning("No products found to migrate")
                 # Создаем завершенную задачу
                 await self.target_store.create_migration_job(job_id, 0)
-                await self.target_store.update_migration_job(job_id, 0, status="completed")
+                await self._update_job(job_id, 0, status="completed")
                 return job_id
 
             # Создаем задачу миграции
             await self.target_store.create_migration_job(job_id, total_products)
+            await self._notify_new_job(job_id)
 
             # Запускаем миграцию в фоне
             asyncio.create_task(self._run_migration_all_collections(job_id, collection_counts))
@@ -82,6 +123,7 @@ class ProductMigrator:
     async def _run_migration_all_collections(self, job_id: str, collection_counts: Dict[str, int]):
         """Выполнить миграцию из всех коллекций"""
         total_migrated = 0
+        failed_collections = []
         start_time = time.time()
 
         try:
@@ -109,28 +151,36 @@ class ProductMigrator:
 
                 except Exception as e:
                     logger.error(f"Error migrating collection {collection_name}: {e}")
+                    failed_collections.append(collection_name)
+                    await self.target_store.add_migration_job_error(
+                        job_id,
+                        {"collection": collection_name, "error": str(e)}
+                    )
                     # Продолжаем с другими коллекциями
                     continue
 
                 # Небольшая пауза между коллекциями
                 await asyncio.sleep(1)
 
-            # Миграция завершена
+            # Миграция завершена; если часть коллекций не перенесена - задача failed
             elapsed_time = time.time() - start_time
+            status = "failed" if failed_collections else "completed"
             logger.info(
-                f"Migration {job_id} completed in {elapsed_time:.2f}s: "
+                f"Migration {job_id} {status} in {elapsed_time:.2f}s: "
                 f"{total_migrated} products migrated"
             )
+            if failed_collections:
+                logger.error(f"Migration {job_id}: collections not fully migrated: {failed_collections}")
 
-            await self.target_store.update_migration_job(
+            await self._update_job(
                 job_id,
                 total_migrated,
-                status="completed"
+                status=status
             )
 
         except Exception as e:
             logger.error(f"Migration {job_id} failed after {total_migrated} products: {e}")
-            await self.target_store.update_migration_job(
+            await self._update_job(
                 job_id,
                 total_migrated,
                 status="failed"
@@ -138,70 +188,173 @@ class ProductMigrator:
             raise
 
     async def _migrate_collection(self, job_id: str, collection_name: str, already_migrated: int) -> int:
-        """Мигрировать товары из одной коллекции"""
+        """
+        Мигрировать товары из одной коллекции
+
+        Чтение из курсора и запись батчей перекрываются: одновременно
+        записывается не больше parallel_batches батчей, при заполнении лимита
+        чтение ждет освобождения слота.
+
+        Батчи завершаются в произвольном порядке, поэтому last_processed_id
+        продвигается только по непрерывной последовательности успешно
+        записанных батчей. Ошибки батчей записываются в задачу; если хотя бы
+        один батч не записан, коллекция завершается ошибкой.
+        """
         migrated_count = 0
         last_id = None
         batch_count = 0
 
-        while True:
-            # Засекаем время батча
-            batch_start_time = time.time()
-            batch_count += 1
+        semaphore = asyncio.Semaphore(self.parallel_batches)
+        # Запущенные записи батчей -> (номер батча, первый _id, последний _id)
+        pending: Dict[asyncio.Task, tuple] = {}
+        # Записанные батчи, до которых last_id еще не дошел: номер -> последний _id
+        written: Dict[int, str] = {}
+        next_batch = 1
+        failed_batches = 0
+
+        async def collect(tasks):
+            nonlocal migrated_count, last_id, next_batch, failed_batches
+            for task in tasks:
+                batch_number, first_id, batch_last_id = pending.pop(task)
+                error = task.exception()
+
+                if error is None:
+                    migrated_count += task.result()
+                    written[batch_number] = batch_last_id
+                    continue
 
-            try:
-                # Получаем батч из коллекции
-                products = await self.source_store.get_products_batch(
-                    limit=self.batch_size,
-                    last_id=last_id,
-                    collection_name=collection_name
-                )
-
-                if not products:
-                    logger.info(f"No more products in collection {collection_name}")
-                    break
-
-                # Вставляем в целевую БД с указанием исходной коллекции
-                inserted = await self.target_store.insert_products_batch(
-                    products,
-                    collection_name  # Передаем имя коллекции
-                )
-
-                # Логирование
-                batch_processing_time = time.time() - batch_start_time
-                duplicates = len(products) - inserted
-
-                logger.info(
-                    f"[{collection_name}] Batch {batch_count}: "
-                    f"{inserted} inserted, {duplicates} duplicates, "
-                    f"time: {batch_processing_time:.2f}s"
-                )
-
-                migrated_count += inserted
-
-                # Запоминаем последний ID
-                if products:
-                    last_id = products[-1]["_id"]
-
-                # Обновляем общий прогресс
-                await self.target_store.update_migration_job(
-                    job_id,
-                    already_migrated + migrated_count,
-                    last_id
-                )
-
-                # Небольшая пауза между батчами
-                await asyncio.sleep(0.1)
-
-            except Exception as e:
-                logger.error(f"Error processing batch {batch_count} from {collection_name}: {e}")
-                # Пробуем продолжить со следующего батча
-                if products and len(products) > 0:
-                    last_id = products[-1]["_id"]
-                await asyncio.sleep(1)
-                continue
+                failed_batches += 1
+                logger.error(f"Error processing batch {batch_number} from {collection_name}: {error}")
+                await self.target_store.add_migration_job_error(job_id, {
+                    "collection": collection_name,
+                    "batch": batch_number,
+                    "first_id": first_id,
+                    "last_id": batch_last_id,
+                    "error": str(error)
+                })
+
+            # Продвигаемся до первого незавершенного или неудачного батча
+            while next_batch in written:
+                last_id = written.pop(next_batch)
+                next_batch += 1
+
+            # Обновляем общий прогресс
+            await self._update_job(
+                job_id,
+                already_migrated + migrated_count,
+                last_id
+            )
 
+        try:
+            # Один курсор на всю коллекцию, товары приходят батчами
+            async for products in self.source_store.iter_products_batches(
+                    batch_size=self.batch_size,
+                    collection_name=collection_name
+            ):
+                batch_count += 1
+
+                await semaphore.acquire()
+                task = asyncio.create_task(self._migrate_batch(collection_name, batch_count, products))
+                task.add_done_callback(lambda _: semaphore.release())
+                pending[task] = (batch_count, products[0]["_id"], products[-1]["_id"])
+
+                done = [task for task in pending if task.done()]
+                if done:
+                    await collect(done)
+        finally:
+            # Дожидаемся уже запущенных записей, даже если чтение прервалось
+            if pending:
+                await asyncio.wait(list(pending))
+                await collect(list(pending))
+
+        if failed_batches:
+            raise Exception(f"{failed_batches} of {batch_count} batches failed to migrate")
+
+        logger.info(f"No more products in collection {collection_name}")
         return migrated_count
 
+    async def _migrate_batch(self, collection_name: str, batch_number: int, products: List[Dict[str, Any]]) -> int:
+        """Записать один батч в целевую БД; возвращает количество вставленных товаров"""
+        batch_start_time = time.time()
+
+        # Вставляем в целевую БД с указанием исходной коллекции
+        inserted = await self.target_store.insert_products_batch(
+            products,
+            collection_name  # Передаем имя коллекции
+        )
+
+        # Логирование
+        batch_processing_time = time.time() - batch_start_time
+        duplicates = len(products) - inserted
+
+        logger.info(
+            "[%s] Batch %d: %d inserted, %d duplicates, time: %.2fs",
+            collection_name, batch_number, inserted, duplicates, batch_processing_time
+        )
+
+        # Пауза только при медленной записи; в остальном нагрузку
+        # ограничивает семафор параллельных батчей
+        if batch_processing_time > SLOW_BATCH_WRITE_SECONDS:
+            await asyncio.sleep(min(MAX_BACKOFF_SECONDS, batch_processing_time))
+
+        return inserted
+
+    async def _update_job(
+            self,
+            job_id: str,
+            migrated_products: int,
+            last_processed_id: Optional[str] = None,
+            status: Optional[str] = None
+    ):
+        """
+        Обновить задачу миграции и опубликовать событие прогресса
+
+        Запись в MongoDB и публикация в Redis выполняются параллельно.
+        Промежуточный прогресс публикуется не чаще progress_publish_interval,
+        смена статуса - всегда.
+        """
+        updates = [
+            self.target_store.update_migration_job(
+                job_id,
+                migrated_products,
+                last_processed_id,
+                status=status
+            )
+        ]
+
+        now = time.monotonic()
+        publish_due = now - self._last_progress_publish >= self.progress_publish_interval
+        if self.redis_client and (status or (publish_due and now >= self._publish_paused_until)):
+            self._last_progress_publish = now
+
+            event = {"migrated_products": migrated_products}
+            if status:
+                event["status"] = status
+            updates.append(self._publish_progress(job_id, event))
+
+        await asyncio.gather(*updates)
+
+    async def _notify_new_job(self, job_id: str):
+        """Сообщить ожидающим воркерам о новой задаче миграции"""
+        if not self.redis_client or not self.notify_workers:
+            return
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                pipe.rpush(MIGRATION_TASKS_QUEUE, job_id)
+                pipe.ltrim(MIGRATION_TASKS_QUEUE, -MIGRATION_TASKS_QUEUE_MAX_LENGTH, -1)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Failed to notify workers about migration {job_id}: {e}")
+
+    async def _publish_progress(self, job_id: str, event: Dict[str, Any]):
+        """Опубликовать событие прогресса миграции в Redis"""
+        try:
+            await self.redis_client.publish(get_migration_channel(job_id), json.dumps(event))
+        except Exception as e:
+            # Redis недоступен - миграция продолжается без событий прогресса
+            self._publish_paused_until = time.monotonic() + self.publish_retry_interval
+            logger.warning(f"Failed to publish migration progress: {e}")
+
     async def resume_migration(self, job_id: str):
         """Продолжить прерванную миграцию"""
         job = await self.target_store.get_migration_job(job_id)
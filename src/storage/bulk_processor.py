@@ -0,0 +1,148 @@
+import asyncio
+import logging
+from typing import List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+
+class BulkProcessor:
+    """
+    Буфер операций записи в MongoDB
+
+    Операции накапливаются и отправляются одним unordered bulk_write, когда
+    набирается max_ops операций или проходит max_interval секунд - что
+    наступит раньше.
+
+    Если запись не прошла целиком (сеть, failover), операции возвращаются в
+    буфер и повторяются с нарастающей паузой. Операции, отклоненные сервером
+    (writeErrors), повторно не отправляются - они логируются и считаются
+    в failed_operations.
+    """
+
+    def __init__(
+            self,
+            collection: AsyncIOMotorCollection,
+            max_ops: int = 500,
+            max_interval: float = 0.25,
+            max_backoff: float = 30.0,
+            close_retries: int = 3
+    ):
+        self.collection = collection
+        self.max_ops = max_ops
+        self.max_interval = max_interval
+        self.max_backoff = max_backoff
+        self.close_retries = close_retries
+
+        self._operations: List = []
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._consecutive_failures = 0
+
+        # Операции, отклоненные сервером
+        self.failed_operations = 0
+
+    def start(self):
+        """Запустить периодический сброс буфера"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def enqueue(self, *operations):
+        """
+        Добавить операции в буфер
+
+        Ошибка записи сюда не пробрасывается: операции остаются в буфере
+        и будут записаны фоновым сбросом.
+        """
+        self._operations.extend(operations)
+
+        if len(self._operations) >= self.max_ops and not self._consecutive_failures:
+            try:
+                await self.flush()
+            except Exception:
+                pass
+
+    async def flush(self):
+        """
+        Записать накопленные операции
+
+        Raises:
+            Exception: если запись не прошла; операции возвращены в буфер
+        """
+        async with self._lock:
+            if not self._operations:
+                return
+
+            operations, self._operations = self._operations, []
+
+            try:
+                result = await self.collection.bulk_write(operations, ordered=False)
+                logger.debug("Bulk processor: %d documents updated", result.modified_count)
+            except BulkWriteError as e:
+                self._log_write_errors(operations, e.details)
+            except Exception as e:
+                # Запись не подтверждена - возвращаем операции в начало буфера
+                self._operations[:0] = operations
+                self._consecutive_failures += 1
+                logger.error(
+                    f"Bulk processor write error, {len(self._operations)} operations kept for retry: {e}"
+                )
+                raise
+
+            self._consecutive_failures = 0
+
+    def _log_write_errors(self, operations: List, details: dict):
+        """Залогировать операции, отклоненные сервером"""
+        write_errors = details.get('writeErrors', [])
+        self.failed_operations += len(write_errors)
+
+        logger.error(
+            f"Bulk processor: {len(write_errors)} of {len(operations)} operations failed "
+            f"(total failed: {self.failed_operations})"
+        )
+        for error in write_errors:
+            operation = operations[error['index']]
+            logger.error(
+                f"Bulk processor: operation {operation} failed with code {error.get('code')}: "
+                f"{error.get('errmsg')}"
+            )
+
+    async def close(self):
+        """
+        Остановить периодический сброс и записать остаток
+
+        Raises:
+            Exception: если остаток не удалось записать за close_retries попыток
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        for attempt in range(1, self.close_retries + 1):
+            try:
+                await self.flush()
+                return
+            except Exception:
+                if attempt < self.close_retries:
+                    await asyncio.sleep(self._backoff_delay())
+
+        raise Exception(f"Bulk processor: {len(self._operations)} buffered operations were not written")
+
+    def _backoff_delay(self) -> float:
+        """Пауза перед следующей попыткой после подряд идущих ошибок"""
+        return min(self.max_backoff, self.max_interval * 2 ** self._consecutive_failures)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._backoff_delay() if self._consecutive_failures else self.max_interval)
+            try:
+                await self.flush()
+            except Exception:
+                # Ошибка уже залогирована, операции остались в буфере
+                pass
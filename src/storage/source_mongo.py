@@ -1,6 +1,8 @@
+import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, AsyncIterator
 from bson import ObjectId
+from pymongo.errors import ConnectionFailure, CursorNotFound
 import logging
 from src.core.config import settings
 
@@ -59,53 +61,70 @@ class SourceMongoStore:
             logger.error(f"Error getting collections list: {e}")
             raise
 
-    async def get_products_batch(
+    async def iter_products_batches(
             self,
-            skip: int = 0,
-            limit: int = 1000,
+            batch_size: int = 1000,
             last_id: Optional[str] = None,
-            collection_name: str = None
-    ) -> List[Dict[str, Any]]:
+            collection_name: str = None,
+            max_retries: int = 3
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
         """
-        Получить батч товаров из конкретной коллекции
-        Извлекаем ТОЛЬКО _id и title
+        Читать товары коллекции батчами через один курсор
+
+        Курсор открывается один раз и отдает документы порциями getMore
+        размером batch_size, без нового запроса и планирования на каждый батч.
+        При сетевой ошибке или потере курсора он открывается заново с
+        _id > последнего прочитанного товара, поэтому чтение продолжается
+        без пропусков и повторов. Чтение начинается после last_id, если он задан.
         """
-        try:
-            # Используем переданную коллекцию или текущую
-            if collection_name:
-                collection = self.db[collection_name]
-            else:
-                collection = self.collection
+        collection = self.db[collection_name] if collection_name else self.collection
 
-            if collection is None:
-                raise ValueError("No collection specified")
+        if collection is None:
+            raise ValueError("No collection specified")
 
-            query = {}
-            if last_id:
-                query = {"_id": {"$gt": ObjectId(last_id)}}
+        # Последний прочитанный _id в исходном виде - граница для повторного открытия
+        last_key = ObjectId(last_id) if last_id else None
+        products = []
+        retries = 0
+
+        while True:
+            query = {"_id": {"$gt": last_key}} if last_key is not None else {}
 
-            # Получаем ТОЛЬКО нужные поля
             cursor = collection.find(
                 query,
                 {"_id": 1, "title": 1}  # Проекция - только эти поля
-            ).limit(limit)
-
-            products = []
-            async for product in cursor:
-                products.append({
-                    "_id": str(product["_id"]),
-                    "title": product.get("title", "")
-                })
-
-            logger.info(f"Fetched {len(products)} products from collection {collection_name or self.collection_name}")
-            return products
-
-        except Exception as e:
-            logger.error(f"Error fetching products from source DB: {e}")
-            raise
+            ).sort("_id", 1).batch_size(batch_size)
+
+            try:
+                async for product in cursor:
+                    retries = 0
+                    last_key = product["_id"]
+                    products.append({
+                        "_id": str(last_key),
+                        "title": product.get("title", "")
+                    })
+
+                    if len(products) >= batch_size:
+                        yield products
+                        products = []
+                break
+            except (ConnectionFailure, CursorNotFound) as e:
+                retries += 1
+                if retries > max_retries:
+                    raise
+                logger.warning(
+                    f"Source cursor for {collection.name} interrupted after _id {last_key}, "
+                    f"reopening (attempt {retries}/{max_retries}): {e}"
+                )
+                await asyncio.sleep(retries)
+            finally:
+                await cursor.close()
+
+        if products:
+            yield products
 
     async def count_total_products(self, collection_name: str = None) -> int:
-        """Подсчитать количество товаров в коллекции"""
+        """Подсчитать количество товаров в коллекции (оценка по метаданным коллекции)"""
         if collection_name:
             collection = self.db[collection_name]
         else:
@@ -114,16 +133,22 @@ class SourceMongoStore:
         if collection is None:
             raise ValueError("No collection specified")
 
-        return await collection.count_documents({})
+        return await collection.estimated_document_count()
 
     async def count_all_products(self) -> Dict[str, int]:
-        """Подсчитать количество товаров во всех коллекциях"""
+        """
+        Подсчитать количество товаров во всех коллекциях
+
+        Используется оценка по метаданным коллекций (estimated_document_count),
+        запросы по коллекциям выполняются параллельно.
+        """
         collections = await self.get_collections_list()
-        counts = {}
 
-        for coll_name in collections:
-            count = await self.count_total_products(coll_name)
-            counts[coll_name] = count
+        collection_counts = await asyncio.gather(*[
+            self.db[coll_name].estimated_document_count()
+            for coll_name in collections
+        ])
+        counts = dict(zip(collections, collection_counts))
 
         total = sum(counts.values())
         logger.info(f"Total products across all collections: {total}")
@@ -1,15 +1,48 @@
+import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
 from typing import List, Dict, Any, Optional
 from datetime import datetime
 from bson import ObjectId
 import logging
-from pymongo import UpdateOne
+import time
+import zlib
+from operator import itemgetter
+from pymongo import IndexModel, ReturnDocument, UpdateOne
 from pymongo.errors import BulkWriteError
 from src.core.config import settings
 from src.models.domain import ProductStatus
 
 logger = logging.getLogger(__name__)
 
+# Поля исходного товара, из которых строится документ целевой БД
+SOURCE_PRODUCT_FIELDS = itemgetter("_id", "title")
+
+# Поля товара, которые можно обновлять через bulk_update_products
+UPDATABLE_PRODUCT_FIELDS = frozenset((
+    # Поля первого этапа
+    "status_stage1",
+    # Поля второго этапа
+    "status_stage2",
+    "okpd2_code",
+    "okpd2_name",
+    "worker_id",
+))
+
+# Количество партиций для распределения товаров между воркерами
+SHARD_BUCKETS = 64
+
+
+def get_shard_bucket(source_id: str) -> int:
+    """Стабильный номер партиции товара (не зависит от PYTHONHASHSEED)"""
+    return zlib.crc32(source_id.encode("utf-8")) % SHARD_BUCKETS
+
+
+def get_worker_shard_buckets(shard_index: int, shard_count: int) -> Optional[List[int]]:
+    """Партиции, закрепленные за воркером; None - воркер работает со всеми товарами"""
+    if shard_count <= 1:
+        return None
+    return [bucket for bucket in range(SHARD_BUCKETS) if bucket % shard_count == shard_index]
+
 
 class TargetMongoStore:
     """Работа с целевой MongoDB (наша новая БД)"""
@@ -59,6 +92,12 @@ class TargetMongoStore:
         self.products = self.db[collection_name]
         self.migration_jobs = self.db.migration_jobs
 
+        # Накопленный прогресс миграций: job_id -> последние значения полей
+        self._pending_progress: Dict[str, Dict[str, Any]] = {}
+        # job_id -> время последней записи прогресса этой задачи
+        self._last_progress_flush: Dict[str, float] = {}
+        self.progress_flush_interval = 0.5  # секунды
+
     async def initialize(self):
         """Инициализация хранилища"""
         connected = await self.test_connection()
@@ -111,36 +150,40 @@ class TargetMongoStore:
     async def _setup_indexes(self):
         """Создать необходимые индексы"""
         try:
-            # Уникальный составной индекс
-            await self.products.create_index(
-                [("source_id", 1), ("source_collection", 1)],
-                unique=True,
-                background=True
-            )
-
-            # Индексы для поиска
-            await self.products.create_index("status_stage1", background=True)
-            await self.products.create_index("status_stage2", background=True)
-            await self.products.create_index("created_at", background=True)
-            await self.products.create_index("okpd_groups", background=True)
-            await self.products.create_index("source_collection", background=True)
-            await self.products.create_index("worker_id", background=True)
-
-            # Составной индекс для эффективного поиска pending товаров
-            await self.products.create_index(
-                [("status_stage1", 1), ("created_at", 1)],
-                background=True
+            # Все индексы коллекции товаров создаются одной командой createIndexes
+            products_indexes = [
+                # Уникальный составной индекс
+                IndexModel([("source_id", 1), ("source_collection", 1)], unique=True, background=True),
+
+                # Составной индекс для атомарного захвата pending товаров:
+                # равенство по статусу и коллекции, порядок по _id.
+                # Префикс status_stage1 обслуживает захват без фильтра по коллекции
+                IndexModel([("status_stage1", 1), ("source_collection", 1), ("_id", 1)], background=True),
+
+                # Индексы для поиска
+                IndexModel([("status_stage2", 1)], background=True),
+                IndexModel([("created_at", 1)], background=True),
+                IndexModel([("okpd_groups", 1)], background=True),
+                IndexModel([("source_collection", 1)], background=True),
+                IndexModel([("worker_id", 1)], background=True),
+
+                # Индекс для захвата товаров по партициям воркеров
+                IndexModel([("shard_bucket", 1), ("status_stage1", 1)], background=True),
+
+                # Составной индекс для эффективного поиска pending товаров
+                IndexModel([("status_stage1", 1), ("created_at", 1)], background=True),
+
+                # Составной индекс для второго этапа (префикс обслуживает
+                # запросы по status_stage1 + status_stage2)
+                IndexModel([("status_stage1", 1), ("status_stage2", 1), ("okpd_groups", 1)], background=True),
+            ]
+
+            await asyncio.gather(
+                self.products.create_indexes(products_indexes),
+                # Индекс для migration_jobs
+                self.migration_jobs.create_index("job_id", unique=True, background=True)
             )
 
-            # Составной индекс для второго этапа
-            await self.products.create_index(
-                [("status_stage1", 1), ("status_stage2", 1)],
-                background=True
-            )
-
-            # Индекс для migration_jobs
-            await self.migration_jobs.create_index("job_id", unique=True, background=True)
-
             logger.info("MongoDB indexes created successfully")
         except Exception as e:
             # Если ошибка аутентификации - это критично
@@ -154,32 +197,58 @@ class TargetMongoStore:
     async def insert_products_batch(self, products: List[Dict[str, Any]], collection_name: str) -> int:
         """
         Вставить батч товаров в целевую БД
+
+        products - товары из SourceMongoStore: _id уже строка (hex ObjectId),
+        в source_id он сохраняется без преобразований.
+
+        Товары записываются upsert-ом по уникальному ключу
+        (source_id, source_collection) с $setOnInsert: уже перенесенные товары
+        не изменяются и не порождают ошибок дубликатов, поэтому повторная
+        миграция коллекции не возвращает тысячи writeErrors.
         """
         if not products:
             return 0
 
-        documents = []
-        for product in products:
-            doc = {
-                "title": product["title"],
-                "created_at": datetime.utcnow(),
-                "source_collection": collection_name,
-                "source_id": product["_id"],
-                "status_stage1": ProductStatus.PENDING.value,
-                # okpd_groups, okpd2_code, okpd2_name будут добавлены при классификации
-            }
-            documents.append(doc)
+        # Одна метка времени и один статус на батч
+        now = datetime.utcnow()
+        pending_status = ProductStatus.PENDING.value
+
+        # okpd_groups, okpd2_code, okpd2_name будут добавлены при классификации
+        operations = [
+            UpdateOne(
+                {"source_id": source_id, "source_collection": collection_name},
+                {
+                    "$setOnInsert": {
+                        "title": title,
+                        "created_at": now,
+                        "shard_bucket": get_shard_bucket(source_id),
+                        "status_stage1": pending_status,
+                    }
+                },
+                upsert=True
+            )
+            for source_id, title in map(SOURCE_PRODUCT_FIELDS, products)
+        ]
 
         try:
-            result = await self.products.insert_many(documents, ordered=False)
-            inserted_count = len(result.inserted_ids)
-            logger.info(f"Inserted {inserted_count} products to target DB")
+            result = await self.products.bulk_write(operations, ordered=False)
+            inserted_count = result.upserted_count
+            logger.debug("Inserted %d products to target DB", inserted_count)
             return inserted_count
 
         except BulkWriteError as e:
+            # Дубликаты возможны только при параллельной вставке того же товара
             write_errors = e.details.get('writeErrors', [])
             duplicate_count = sum(1 for error in write_errors if error['code'] == 11000)
-            inserted_count = e.details.get('nInserted', 0)
+            inserted_count = e.details.get('nUpserted', 0)
+
+            if duplicate_count < len(write_errors):
+                # Кроме дубликатов есть другие ошибки - батч перенесен не полностью
+                first_error = next(error for error in write_errors if error['code'] != 11000)
+                raise Exception(
+                    f"{len(write_errors) - duplicate_count} products failed to insert: "
+                    f"{first_error.get('errmsg')}"
+                ) from e
 
             logger.warning(
                 f"Batch insert completed with {inserted_count} inserted, "
@@ -193,26 +262,116 @@ class TargetMongoStore:
 
     async def get_pending_products(self, limit: int = 50) -> List[Dict[str, Any]]:
         """Получить товары для классификации"""
+        # batch_size(limit) - весь результат приходит в первом ответе без getMore
         cursor = self.products.find(
-            {"status_stage1": ProductStatus.PENDING.value}
-        ).limit(limit)
+            {"status_stage1": ProductStatus.PENDING.value},
+            {"_id": 1, "title": 1, "source_collection": 1}
+        ).batch_size(limit).limit(limit)
         return await cursor.to_list(length=limit)
 
-    async def get_pending_products_atomic(self, limit: int = 50, worker_id: str = None) -> List[Dict[str, Any]]:
-        """Атомарно получить и заблокировать товары для классификации"""
+    async def get_pending_products_atomic(
+            self,
+            limit: int = 50,
+            worker_id: str = None,
+            source_collection: Optional[str] = None,
+            shard_buckets: Optional[List[int]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Атомарно получить и заблокировать товары для классификации
+
+        Если переданы shard_buckets, сначала захватываются товары из партиций
+        воркера, чтобы воркеры не конкурировали за один и тот же документ.
+        Когда своя партиция пуста, захват продолжается из общего пула.
+        """
         products = []
 
+        filter_query = {"status_stage1": ProductStatus.PENDING.value}
+        if source_collection:
+            filter_query["source_collection"] = source_collection
+
+        # Порядок по _id индекс (status_stage1, source_collection, _id) отдает
+        # только при равенстве по коллекции; без него сортировка была бы в памяти
+        sort = [("_id", 1)] if source_collection else None
+
+        shard_filter_query = None
+        if shard_buckets:
+            shard_filter_query = {**filter_query, "shard_bucket": {"$in": shard_buckets}}
+
+        update_query = {
+            "$set": {
+                "status_stage1": ProductStatus.PROCESSING.value,
+                "worker_id": worker_id,
+                "processing_started_at": datetime.utcnow()
+            }
+        }
+
+        for _ in range(limit):
+            doc = None
+
+            if shard_filter_query:
+                doc = await self._claim_pending_product(shard_filter_query, update_query)
+                if not doc:
+                    # Своя партиция пуста - переходим к общему пулу
+                    shard_filter_query = None
+
+            if not doc:
+                doc = await self._claim_pending_product(filter_query, update_query, sort)
+
+            if doc:
+                products.append(doc)
+            else:
+                break
+
+        if products:
+            logger.debug("Locked %d products for processing by %s", len(products), worker_id)
+
+        return products
+
+    async def _claim_pending_product(
+            self,
+            filter_query: Dict[str, Any],
+            update_query: Dict[str, Any],
+            sort: Optional[List[tuple]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Захватить один pending товар"""
+        return await self.products.find_one_and_update(
+            filter_query,
+            update_query,
+            sort=sort,
+            # Классификатору нужны только идентификатор и название
+            projection={"_id": 1, "title": 1, "source_collection": 1},
+            return_document=ReturnDocument.AFTER
+        )
+
+    @staticmethod
+    def get_stage2_pending_filter() -> Dict[str, Any]:
+        """Фильтр товаров, готовых ко второму этапу классификации"""
+        return {
+            "status_stage1": ProductStatus.CLASSIFIED.value,
+            "okpd_groups": {"$exists": True, "$ne": []},
+            "$or": [
+                {"status_stage2": {"$exists": False}},
+                {"status_stage2": ProductStatus.PENDING.value}
+            ]
+        }
+
+    async def get_pending_products_stage2_atomic(self, limit: int = 50, worker_id: str = None) -> List[Dict[str, Any]]:
+        """Атомарно получить и заблокировать товары для второго этапа"""
+        products = []
+        filter_query = self.get_stage2_pending_filter()
+
         for _ in range(limit):
             doc = await self.products.find_one_and_update(
-                {"status_stage1": ProductStatus.PENDING.value},
+                filter_query,
                 {
                     "$set": {
-                        "status_stage1": ProductStatus.PROCESSING.value,
-                        "worker_id": worker_id,
-                        "processing_started_at": datetime.utcnow()
+                        "status_stage2": ProductStatus.PROCESSING.value,
+                        "worker_id": worker_id
                     }
                 },
-                return_document=True
+                # Для второго этапа нужны название и группы первого этапа
+                projection={"_id": 1, "title": 1, "okpd_groups": 1, "source_collection": 1},
+                return_document=ReturnDocument.AFTER
             )
 
             if doc:
@@ -221,78 +380,86 @@ class TargetMongoStore:
                 break
 
         if products:
-            logger.info(f"Locked {len(products)} products for processing by {worker_id}")
+            logger.debug("Locked %d products for stage 2 processing by %s", len(products), worker_id)
 
         return products
 
     async def bulk_update_products(self, updates: List[Dict[str, Any]]):
         """Массовое обновление товаров"""
-        if not updates:
+        bulk_operations = self.build_update_operations(updates)
+
+        if not bulk_operations:
             return
 
-        bulk_operations = []
+        try:
+            result = await self.products.bulk_write(bulk_operations)
+            logger.info(f"Bulk update: {result.modified_count} products updated")
+        except Exception as e:
+            logger.error(f"Bulk update error: {e}")
+            raise
+
+    def build_update_operations(self, updates: List[Dict[str, Any]]) -> List[UpdateOne]:
+        """Преобразовать обновления товаров в операции UpdateOne"""
+        if not updates:
+            return []
+
         current_time = datetime.utcnow()
 
-        for update in updates:
-            try:
-                product_id = update["_id"]
+        # Один проход: валидируем id и собираем $set для каждого обновления
+        product_ids = []
+        set_operations = []
 
-                # Формируем filter
-                if isinstance(product_id, ObjectId):
-                    filter_query = {"_id": product_id}
-                elif isinstance(product_id, str) and ObjectId.is_valid(product_id):
-                    filter_query = {"_id": ObjectId(product_id)}
-                else:
-                    logger.error(f"Invalid product_id: {product_id}")
-                    continue
+        for update in updates:
+            product_id = update.get("_id")
 
-                # Обновляем поля
-                update_data = {"updated_at": current_time}
-                data = update.get("data", {})
+            if isinstance(product_id, str) and ObjectId.is_valid(product_id):
+                product_id = ObjectId(product_id)
+            elif not isinstance(product_id, ObjectId):
+                logger.error(f"Invalid product_id: {product_id}")
+                continue
 
-                # Поля первого этапа
-                if "status_stage1" in data:
-                    update_data["status_stage1"] = data["status_stage1"]
+            update_data = self._build_update_data(update.get("data", {}), current_time)
 
-                if "okpd_group" in data:  # Переименовываем в okpd_groups
-                    update_data["okpd_groups"] = data["okpd_group"]
+            # Нечего обновлять - не отправляем пустой $set
+            if not update_data:
+                continue
 
-                # Поля второго этапа
-                if "status_stage2" in data:
-                    update_data["status_stage2"] = data["status_stage2"]
+            product_ids.append(product_id)
+            set_operations.append({"$set": update_data})
 
-                if "okpd2_code" in data:
-                    update_data["okpd2_code"] = data["okpd2_code"]
+        return [
+            UpdateOne({"_id": product_id}, set_operation)
+            for product_id, set_operation in zip(product_ids, set_operations)
+        ]
 
-                if "okpd2_name" in data:
-                    update_data["okpd2_name"] = data["okpd2_name"]
+    @staticmethod
+    def _build_update_data(data: Dict[str, Any], current_time: datetime) -> Dict[str, Any]:
+        """Сформировать обновляемые поля товара"""
+        update_data = {field: data[field] for field in UPDATABLE_PRODUCT_FIELDS.intersection(data)}
 
-                if "worker_id" in data:
-                    update_data["worker_id"] = data["worker_id"]
+        if "okpd_group" in data:  # Переименовываем в okpd_groups
+            update_data["okpd_groups"] = data["okpd_group"]
 
-                # Если товар классифицирован на любом этапе - обновляем processed_at
-                if (data.get("status_stage1") == ProductStatus.CLASSIFIED.value or
-                        data.get("status_stage2") == ProductStatus.CLASSIFIED.value):
-                    update_data["processed_at"] = current_time
+        if not update_data:
+            return update_data
 
-                operation = UpdateOne(filter_query, {"$set": update_data})
-                bulk_operations.append(operation)
+        update_data["updated_at"] = current_time
 
-            except Exception as e:
-                logger.error(f"Error preparing bulk operation: {e}")
-                continue
+        # Если товар классифицирован на любом этапе - обновляем processed_at
+        if (data.get("status_stage1") == ProductStatus.CLASSIFIED.value or
+                data.get("status_stage2") == ProductStatus.CLASSIFIED.value):
+            update_data["processed_at"] = current_time
 
-        if bulk_operations:
-            try:
-                result = await self.products.bulk_write(bulk_operations)
-                logger.info(f"Bulk update: {result.modified_count} products updated")
-            except Exception as e:
-                logger.error(f"Bulk update error: {e}")
-                raise
+        return update_data
 
     async def get_statistics(self) -> Dict[str, int]:
-        """Получить статистику по товарам"""
-        total = await self.products.count_documents({})
+        """
+        Получить статистику по товарам
+
+        total берется из метаданных коллекции (estimated_document_count) и
+        может быть приблизительным во время активной записи
+        """
+        total = await self.products.estimated_document_count()
         pending = await self.products.count_documents({"status_stage1": ProductStatus.PENDING.value})
         processing = await self.products.count_documents({"status_stage1": ProductStatus.PROCESSING.value})
         classified = await self.products.count_documents({"status_stage1": ProductStatus.CLASSIFIED.value})
@@ -368,27 +535,102 @@ class TargetMongoStore:
             last_processed_id: Optional[str] = None,
             status: Optional[str] = None
     ):
-        """Обновить прогресс миграции"""
-        update_data = {
-            "migrated_products": migrated_products,
-            "updated_at": datetime.utcnow()
-        }
+        """
+        Обновить прогресс миграции
+
+        Промежуточный прогресс накапливается в памяти и записывается не чаще
+        раза в progress_flush_interval секунд - важны только последние значения.
+        Смена статуса записывается сразу вместе с накопленным прогрессом.
+        """
+        update_data = self._pending_progress.setdefault(job_id, {})
+        update_data["migrated_products"] = migrated_products
+        update_data["updated_at"] = datetime.utcnow()
 
         if last_processed_id:
             update_data["last_processed_id"] = last_processed_id
 
         if status:
             update_data["status"] = status
+            await self.flush_progress(job_id)
+            return
 
+        last_flush = self._last_progress_flush.get(job_id, 0.0)
+        if time.monotonic() - last_flush >= self.progress_flush_interval:
+            await self.flush_progress(job_id)
+
+    async def flush_progress(self, job_id: Optional[str] = None):
+        """Записать накопленный прогресс миграции (всех задач, если job_id не указан)"""
+        job_ids = [job_id] if job_id else list(self._pending_progress)
+
+        for pending_job_id in job_ids:
+            update_data = self._pending_progress.pop(pending_job_id, None)
+            if not update_data:
+                continue
+
+            await self.migration_jobs.update_one(
+                {"job_id": pending_job_id},
+                {"$set": update_data}
+            )
+
+            if "status" in update_data:
+                # Задача сменила статус - дальнейших промежуточных записей не ждем
+                self._last_progress_flush.pop(pending_job_id, None)
+            else:
+                self._last_progress_flush[pending_job_id] = time.monotonic()
+
+    async def add_migration_job_error(self, job_id: str, error: Dict[str, Any]):
+        """Записать ошибку в задачу миграции (хранятся последние 100)"""
         await self.migration_jobs.update_one(
             {"job_id": job_id},
-            {"$set": update_data}
+            {
+                "$push": {"errors": {"$each": [{**error, "at": datetime.utcnow()}], "$slice": -100}},
+                "$set": {"updated_at": datetime.utcnow()}
+            }
         )
 
     async def get_migration_job(self, job_id: str) -> Optional[Dict[str, Any]]:
         """Получить информацию о задаче миграции"""
         return await self.migration_jobs.find_one({"job_id": job_id})
 
+    async def get_migration_jobs_overview(self) -> Dict[str, Any]:
+        """
+        Получить активную задачу миграции и последнюю завершенную
+
+        Оба запроса выполняются одной агрегацией ($facet) за один round trip.
+        Из каждой выборки берется один документ и только нужные поля.
+        """
+        job_projection = {"$project": {"_id": 0, "job_id": 1, "migrated_products": 1, "total_products": 1}}
+
+        pipeline = [
+            {
+                "$facet": {
+                    "running": [
+                        {"$match": {"status": "running"}},
+                        {"$limit": 1},
+                        job_projection
+                    ],
+                    "last_completed": [
+                        {"$match": {"status": "completed"}},
+                        {"$sort": {"updated_at": -1}},
+                        {"$limit": 1},
+                        job_projection
+                    ]
+                }
+            }
+        ]
+
+        result = await self.migration_jobs.aggregate(pipeline).to_list(length=1)
+        facets = result[0] if result else {}
+
+        return {
+            "running": next(iter(facets.get("running", [])), None),
+            "last_completed": next(iter(facets.get("last_completed", [])), None)
+        }
+
     async def close(self):
         """Закрыть соединение"""
+        try:
+            await self.flush_progress()
+        except Exception as e:
+            logger.warning(f"Failed to flush migration progress on close: {e}")
         self.client.close()
\ No newline at end of file
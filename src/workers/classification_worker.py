@@ -1,20 +1,18 @@
 import asyncio
 import logging
 import sys
+from typing import Optional
 
-from src.services.ai_client import AnthropicClient
-from src.storage.target_mongo import TargetMongoStore
+from src.services.ai_client import get_client
+from src.storage.bulk_processor import BulkProcessor
+from src.storage.target_mongo import TargetMongoStore, get_worker_shard_buckets
 from src.services.classifier import StageOneClassifier
 from src.core.config import settings
+from src.core.logging_setup import setup_logging
+from src.workers.entrypoint import WorkerConfig, install_shutdown_handlers
 
 # Настройка логирования для воркера
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+setup_logging(logging.INFO)
 
 logger = logging.getLogger(__name__)
 
@@ -22,15 +20,27 @@ logger = logging.getLogger(__name__)
 class ClassificationWorker:
     """Воркер для классификации товаров"""
 
-    def __init__(self, worker_id: str = "worker_1", collection_name: str = None):
+    def __init__(
+            self,
+            worker_id: str = "worker_1",
+            collection_name: str = None,
+            shard_index: int = 0,
+            shard_count: int = 1,
+            batch_size: Optional[int] = None
+    ):
         self.worker_id = worker_id
         self.collection_name = collection_name
+        self.batch_size = batch_size or settings.classification_batch_size
+        self.shard_buckets = get_worker_shard_buckets(shard_index, shard_count)
         self.target_store = None
         self.classifier = None
+        self.bulk_processor = None
         self.running = False
         logger.info(f"Initializing classification worker: {self.worker_id}")
         if collection_name:
             logger.info(f"Worker will process only collection: {collection_name}")
+        if self.shard_buckets:
+            logger.info(f"Worker shard: {shard_index}/{shard_count} ({len(self.shard_buckets)} buckets)")
 
     async def start(self):
         """Запустить воркер"""
@@ -52,25 +62,34 @@ class ClassificationWorker:
             logger.info(f"Using model: {settings.anthropic_model}")
             logger.info(f"Proxy configured: {'Yes' if settings.proxy_url else 'No'}")
 
-            ai_client = AnthropicClient(
+            # Параллельность запросов к AI подстраивается под задержки и ошибки API
+            ai_client = get_client(
                 settings.anthropic_api_key,
-                settings.anthropic_model
+                settings.anthropic_model,
+                settings.proxy_url,
+                max_concurrency=settings.classification_concurrency
             )
 
-            logger.info(f"Creating classifier with batch_size={settings.classification_batch_size}")
+            # Результаты классификации пишутся общими bulk-записями
+            self.bulk_processor = BulkProcessor(self.target_store.products)
+            self.bulk_processor.start()
+
+            logger.info(f"Creating classifier with batch_size={self.batch_size}")
             self.classifier = StageOneClassifier(
                 ai_client,
                 self.target_store,
-                settings.classification_batch_size,
+                self.batch_size,
                 worker_id=self.worker_id,
-                collection_name=self.collection_name
+                collection_name=self.collection_name,
+                shard_buckets=self.shard_buckets,
+                bulk_processor=self.bulk_processor
             )
 
             self.running = True
             logger.info(f"Worker {self.worker_id} initialized successfully. Starting continuous classification...")
 
-            # Запускаем непрерывную классификацию
-            await self.classifier.run_continuous_classification()
+            # Запускаем непрерывную классификацию в конвейерном режиме
+            await self.classifier.run_pipelined_classification(settings.classification_concurrency)
 
         except KeyboardInterrupt:
             logger.info(f"Worker {self.worker_id} interrupted by user")
@@ -86,55 +105,53 @@ class ClassificationWorker:
         logger.info(f"Stopping classification worker {self.worker_id}...")
         self.running = False
 
-        if self.target_store:
-            logger.info("Closing target store connection...")
-            await self.target_store.close()
+        try:
+            if self.bulk_processor:
+                logger.info("Flushing buffered writes...")
+                await self.bulk_processor.close()
+        finally:
+            if self.target_store:
+                logger.info("Closing target store connection...")
+                await self.target_store.close()
 
         logger.info(f"Worker {self.worker_id} stopped successfully")
 
 
 async def main():
     """Запуск воркера из командной строки"""
-    import argparse
-
-    parser = argparse.ArgumentParser(description='Classification worker')
-    parser.add_argument('--worker-id', default='worker_1', help='Worker ID')
-    parser.add_argument('--collection', default=None, help='Process only specific collection')
-    parser.add_argument('--log-level', default='INFO',
-                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
-                        help='Logging level')
-    args = parser.parse_args()
-
-    # Определяем collection_name с учетом приоритетов:
-    # 1. Параметр командной строки
-    # 2. Переменная окружения SOURCE_COLLECTION_NAME
-    collection_name = args.collection
-    if collection_name is None and settings.source_collection_name:
-        collection_name = settings.source_collection_name
-        logger.info(f"Using collection from env: {collection_name}")
-
-    # Настройка уровня логирования из аргументов
-    log_level = getattr(logging, args.log_level.upper())
-    logging.getLogger().setLevel(log_level)
-
-    # Также настроим логирование для всех модулей src
-    logging.getLogger('src').setLevel(log_level)
+    cfg = WorkerConfig.parse(
+        'Classification worker',
+        default_worker_id='worker_1',
+        default_batch_size=settings.classification_batch_size,
+        with_collection=True,
+        with_shard=True
+    )
+    cfg.apply_log_level()
+    install_shutdown_handlers()
 
     logger.info("=" * 60)
     logger.info("OKPD2 Classification Worker Starting")
     logger.info("=" * 60)
-    logger.info(f"Worker ID: {args.worker_id}")
-    logger.info(f"Collection: {collection_name or 'ALL'}")
-    logger.info(f"Log Level: {args.log_level}")
-    logger.info(f"Batch Size: {settings.classification_batch_size}")
+    logger.info(f"Worker ID: {cfg.worker_id}")
+    logger.info(f"Collection: {cfg.collection or 'ALL'}")
+    logger.info(f"Shard: {cfg.shard_index}/{cfg.shard_count}")
+    logger.info(f"Log Level: {cfg.log_level_name}")
+    logger.info(f"Batch Size: {cfg.batch_size}")
+    logger.info(f"Concurrency: {settings.classification_concurrency}")
     logger.info(f"Rate Limit Delay: {settings.rate_limit_delay}s")
     logger.info(f"Max Retries: {settings.max_retries}")
     logger.info("=" * 60)
 
     try:
-        worker = ClassificationWorker(args.worker_id, collection_name)
+        worker = ClassificationWorker(
+            cfg.worker_id,
+            cfg.collection,
+            cfg.shard_index,
+            cfg.shard_count,
+            batch_size=cfg.batch_size
+        )
         await worker.start()
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, asyncio.CancelledError):
         logger.info("Shutdown requested by user")
     except Exception as e:
         logger.error(f"Fatal error: {e}", exc_info=True)
@@ -142,4 +159,4 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
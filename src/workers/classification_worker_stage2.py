@@ -3,21 +3,17 @@ import logging
 import sys
 from typing import Optional
 
-from src.services.ai_client import AnthropicClient
+from src.services.ai_client import get_client
+from src.storage.bulk_processor import BulkProcessor
 from src.storage.target_mongo import TargetMongoStore
 from src.services.classifier_stage2 import StageTwoClassifier
 from src.core.config import settings
-
-
+from src.data.okpd_tree import OKPD2_FULL_TREE_PATH, get_table
+from src.core.logging_setup import setup_logging
+from src.workers.entrypoint import WorkerConfig, install_shutdown_handlers
 
 # Настройка логирования для воркера
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+setup_logging(logging.INFO)
 
 logger = logging.getLogger(__name__)
 
@@ -25,10 +21,13 @@ logger = logging.getLogger(__name__)
 class ClassificationWorkerStage2:
     """Воркер для классификации товаров на втором этапе"""
 
-    def __init__(self, worker_id: str = "stage2_worker_1"):
+    def __init__(self, worker_id: str = "stage2_worker_1", batch_size: Optional[int] = None):
         self.worker_id = worker_id
+        # Используем меньший размер батча для второго этапа
+        self.batch_size = batch_size or min(settings.classification_batch_size, 15)
         self.target_store = None
         self.classifier = None
+        self.bulk_processor = None
         self.running = False
         logger.info(f"Initializing stage 2 classification worker: {self.worker_id}")
 
@@ -48,18 +47,19 @@ class ClassificationWorkerStage2:
             logger.info("Initializing target store...")
             await self.target_store.initialize()
 
-            # Проверяем наличие товаров для второго этапа
-            count = await self.target_store.products.count_documents({
-                "status_stage1": "classified",
-                "okpd_groups": {"$exists": True, "$ne": []},
-                "$or": [
-                    {"status_stage2": {"$exists": False}},
-                    {"status_stage2": "pending"}
-                ]
-            })
-            logger.info(f"Found {count} products ready for stage 2 classification")
-
-            if count == 0:
+            # Проверяем наличие товаров для второго этапа - достаточно одного документа
+            stage2_filter = self.target_store.get_stage2_pending_filter()
+            has_work = await self.target_store.products.find(
+                stage2_filter,
+                {"_id": 1}
+            ).limit(1).to_list(length=1)
+
+            # Точный подсчет - полный проход по индексу, только для отладки
+            if logger.isEnabledFor(logging.DEBUG):
+                count = await self.target_store.products.count_documents(stage2_filter)
+                logger.debug("Found %d products ready for stage 2 classification", count)
+
+            if not has_work:
                 logger.warning("No products found for stage 2 classification!")
                 logger.info("Make sure stage 1 classification is completed first.")
                 return
@@ -68,27 +68,34 @@ class ClassificationWorkerStage2:
             logger.info(f"Using model: {settings.anthropic_model}")
             logger.info(f"Proxy configured: {'Yes' if settings.proxy_url else 'No'}")
 
-            ai_client = AnthropicClient(
+            # Второй этап обрабатывает классы последовательно - контроллер
+            # нужен для паузы по retry-after и сброса при 429/529
+            ai_client = get_client(
                 settings.anthropic_api_key,
-                settings.anthropic_model
+                settings.anthropic_model,
+                settings.proxy_url,
+                max_concurrency=1
             )
 
-            # Используем меньший размер батча для второго этапа
-            batch_size = min(settings.classification_batch_size, 15)
+            # Результаты классификации пишутся общими bulk-записями
+            self.bulk_processor = BulkProcessor(self.target_store.products)
+            self.bulk_processor.start()
 
-            logger.info(f"Creating stage 2 classifier with batch_size={batch_size}")
+            logger.info(f"Creating stage 2 classifier with batch_size={self.batch_size}")
             self.classifier = StageTwoClassifier(
                 ai_client=ai_client,
                 target_store=self.target_store,
-                batch_size=batch_size,
-                worker_id=self.worker_id
+                batch_size=self.batch_size,
+                worker_id=self.worker_id,
+                bulk_processor=self.bulk_processor
                 # Убрал collection_name - его нет в конструкторе StageTwoClassifier
             )
 
-            # Проверяем наличие файла с полным деревом ОКПД2
-            import os
-            if not os.path.exists("src/data/okpd2_full_tree.json"):
-                logger.error("OKPD2 full tree file not found at src/data/okpd2_full_tree.json")
+            # Проверяем наличие файла с полным деревом ОКПД2 (уже загружен классификатором)
+            try:
+                get_table()
+            except FileNotFoundError:
+                logger.error(f"OKPD2 full tree file not found at {OKPD2_FULL_TREE_PATH}")
                 logger.error("Please create this file with the complete OKPD2 hierarchy")
                 logger.error("Format: {\"XX\": {\"XX.XX.X\": \"Description\", ...}, ...}")
                 return
@@ -113,37 +120,34 @@ class ClassificationWorkerStage2:
         logger.info(f"Stopping stage 2 classification worker {self.worker_id}...")
         self.running = False
 
-        if self.target_store:
-            logger.info("Closing target store connection...")
-            await self.target_store.close()
+        try:
+            if self.bulk_processor:
+                logger.info("Flushing buffered writes...")
+                await self.bulk_processor.close()
+        finally:
+            if self.target_store:
+                logger.info("Closing target store connection...")
+                await self.target_store.close()
 
         logger.info(f"Stage 2 worker {self.worker_id} stopped successfully")
 
 
 async def main():
     """Запуск воркера из командной строки"""
-    import argparse
-
-    parser = argparse.ArgumentParser(description='Stage 2 Classification worker')
-    parser.add_argument('--worker-id', default='stage2_worker_1', help='Worker ID')
-    parser.add_argument('--log-level', default='INFO',
-                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
-                        help='Logging level')
-    args = parser.parse_args()
-
-    # Настройка уровня логирования из аргументов
-    log_level = getattr(logging, args.log_level.upper())
-    logging.getLogger().setLevel(log_level)
-
-    # Также настроим логирование для всех модулей src
-    logging.getLogger('src').setLevel(log_level)
+    cfg = WorkerConfig.parse(
+        'Stage 2 Classification worker',
+        default_worker_id='stage2_worker_1',
+        default_batch_size=min(settings.classification_batch_size, 15)
+    )
+    cfg.apply_log_level()
+    install_shutdown_handlers()
 
     logger.info("=" * 60)
     logger.info("OKPD2 Stage 2 Classification Worker Starting")
     logger.info("=" * 60)
-    logger.info(f"Worker ID: {args.worker_id}")
-    logger.info(f"Log Level: {args.log_level}")
-    logger.info(f"Batch Size: {min(settings.classification_batch_size, 15)}")
+    logger.info(f"Worker ID: {cfg.worker_id}")
+    logger.info(f"Log Level: {cfg.log_level_name}")
+    logger.info(f"Batch Size: {cfg.batch_size}")
     logger.info(f"Rate Limit Delay: {settings.rate_limit_delay}s")
     logger.info(f"Max Retries: {settings.max_retries}")
     logger.info("=" * 60)
@@ -151,9 +155,9 @@ async def main():
     logger.info("=" * 60)
 
     try:
-        worker = ClassificationWorkerStage2(args.worker_id)
+        worker = ClassificationWorkerStage2(cfg.worker_id, batch_size=cfg.batch_size)
         await worker.start()
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, asyncio.CancelledError):
         logger.info("Shutdown requested by user")
     except Exception as e:
         logger.error(f"Fatal error: {e}", exc_info=True)
@@ -161,4 +165,4 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
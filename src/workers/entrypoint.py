@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import logging
+import signal
+from dataclasses import dataclass
+from typing import List, Optional
+
+from src.core.config import settings
+
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+
+@dataclass(frozen=True, slots=True)
+class WorkerConfig:
+    """Параметры запуска воркера: разбираются один раз при старте процесса"""
+
+    worker_id: str
+    collection: Optional[str]
+    log_level: int
+    batch_size: int
+    shard_index: int = 0
+    shard_count: int = 1
+    job_id: Optional[str] = None
+
+    @property
+    def log_level_name(self) -> str:
+        return logging.getLevelName(self.log_level)
+
+    @classmethod
+    def parse(
+            cls,
+            description: str,
+            default_worker_id: str,
+            default_batch_size: int,
+            argv: Optional[List[str]] = None,
+            *,
+            with_collection: bool = False,
+            with_shard: bool = False,
+            with_job_id: bool = False
+    ) -> "WorkerConfig":
+        """
+        Разобрать аргументы командной строки и настройки окружения
+
+        Флаги with_* включают опции, которые воркер действительно использует;
+        остальные argparse отклоняет.
+        """
+        parser = argparse.ArgumentParser(description=description)
+        parser.add_argument('--worker-id', default=default_worker_id, help='Worker ID')
+        if with_collection:
+            parser.add_argument('--collection', default=None, help='Process only specific collection')
+        if with_shard:
+            parser.add_argument('--shard-index', type=int, default=0, help='Worker index for claim partitioning')
+            parser.add_argument('--shard-count', type=int, default=1, help='Total number of partitioned workers')
+        if with_job_id:
+            parser.add_argument('--job-id', help='Resume specific job')
+        parser.add_argument('--batch-size', type=int, default=default_batch_size, help='Batch size')
+        parser.add_argument('--log-level', default='INFO', choices=LOG_LEVELS, help='Logging level')
+        args = parser.parse_args(argv)
+
+        shard_index = getattr(args, 'shard_index', 0)
+        shard_count = getattr(args, 'shard_count', 1)
+        if not 0 <= shard_index < max(1, shard_count):
+            parser.error("--shard-index must be in range [0, --shard-count)")
+
+        if args.batch_size <= 0:
+            parser.error("--batch-size must be positive")
+
+        # Определяем collection с учетом приоритетов:
+        # 1. Параметр командной строки
+        # 2. Переменная окружения SOURCE_COLLECTION_NAME
+        collection = None
+        if with_collection:
+            collection = args.collection
+            if collection is None and settings.source_collection_name:
+                collection = settings.source_collection_name
+
+        return cls(
+            worker_id=args.worker_id,
+            collection=collection,
+            log_level=getattr(logging, args.log_level),
+            batch_size=args.batch_size,
+            shard_index=shard_index,
+            shard_count=shard_count,
+            job_id=getattr(args, 'job_id', None)
+        )
+
+    def apply_log_level(self):
+        """Установить уровень логирования для процесса и модулей src"""
+        logging.getLogger().setLevel(self.log_level)
+        logging.getLogger('src').setLevel(self.log_level)
+
+
+def install_shutdown_handlers():
+    """
+    Завершать текущую задачу по SIGINT/SIGTERM
+
+    Задача отменяется, и воркер штатно освобождает ресурсы в finally/stop():
+    сбрасывает буферизованные записи, возвращает захваченные товары, закрывает
+    подключения к MongoDB и Redis. Вызывается из main() внутри event loop.
+    Повторные сигналы игнорируются, чтобы не прервать уже идущую очистку.
+    """
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    signals = (signal.SIGINT, signal.SIGTERM)
+
+    def shutdown():
+        for sig in signals:
+            loop.add_signal_handler(sig, lambda: None)
+        task.cancel()
+
+    for sig in signals:
+        loop.add_signal_handler(sig, shutdown)
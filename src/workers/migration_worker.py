@@ -3,37 +3,58 @@
 Migration worker для работы со всеми коллекциями
 """
 import asyncio
+import json
 import logging
-import sys
-from typing import Optional
-from redis.asyncio import Redis
+import time
+import uuid
+from typing import Optional, Dict, Any
+from pymongo.errors import PyMongoError
+from redis.asyncio import BlockingConnectionPool, Redis
 
 from src.storage.source_mongo import SourceMongoStore
 from src.storage.target_mongo import TargetMongoStore
-from src.services.product_migrator import ProductMigrator
+from src.services.product_migrator import ProductMigrator, MIGRATION_TASKS_QUEUE, get_migration_channel
 from src.core.config import settings
+from src.core.logging_setup import setup_logging
+from src.workers.entrypoint import WorkerConfig, install_shutdown_handlers
 
 # Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+setup_logging(logging.INFO)
 
 logger = logging.getLogger(__name__)
 
+# Блокировка миграции в Redis: TTL и интервал продления
+MIGRATION_LOCK_TTL = 180
+MIGRATION_LOCK_RENEW_INTERVAL = 60
+
+# Продлить блокировку, только если она все еще принадлежит этому воркеру
+RENEW_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+else
+    return 0
+end
+"""
+
 
 class MigrationWorker:
     """Воркер для миграции товаров из всех коллекций"""
 
-    def __init__(self):
+    def __init__(self, worker_id: Optional[str] = None, batch_size: Optional[int] = None):
         self.source_store = None
         self.target_store = None
         self.migrator = None
         self.redis_client = None
+        self.redis_pool = None
+        self._renew_lock = None
         self.running = False
+        # Пробуждение цикла ожидания новых задач: stop(), изменения migration_jobs
+        # или уведомление о новой задаче в Redis
+        self._wake = asyncio.Event()
+        self._watch_tasks = []
+        # Токен владельца блокировок миграции в Redis
+        self.worker_id = worker_id or f"migration_worker_{uuid.uuid4().hex[:8]}"
+        self.batch_size = batch_size or settings.migration_batch_size
 
     async def initialize_stores(self):
         """Инициализировать подключения к БД"""
@@ -44,16 +65,6 @@ class MigrationWorker:
             None  # Не указываем коллекцию - будем работать со всеми
         )
 
-        # Проверяем подключение к source
-        if not await self.source_store.test_connection():
-            logger.error("Failed to connect to source MongoDB!")
-            logger.error("Please check your .env file settings:")
-            logger.error("- SOURCE_MONGO_HOST, SOURCE_MONGO_PORT")
-            logger.error("- SOURCE_MONGO_USER, SOURCE_MONGO_PASS")
-            logger.error("- SOURCE_MONGO_AUTHSOURCE")
-            logger.error("- SOURCE_MONGO_DIRECT_CONNECTION")
-            raise Exception("Cannot connect to source MongoDB")
-
         # Инициализируем target store
         logger.info("Connecting to target MongoDB...")
         logger.info(f"Using target collection name from settings: {settings.target_collection_name}")
@@ -62,8 +73,23 @@ class MigrationWorker:
             settings.target_collection_name
         )
 
-        # Проверяем подключение к target
-        if not await self.target_store.test_connection():
+        # Проверяем подключения к обеим БД параллельно
+        source_ok, target_ok = await asyncio.gather(
+            self.source_store.test_connection(),
+            self.target_store.test_connection(),
+            return_exceptions=True
+        )
+
+        if source_ok is not True:
+            logger.error("Failed to connect to source MongoDB!")
+            logger.error("Please check your .env file settings:")
+            logger.error("- SOURCE_MONGO_HOST, SOURCE_MONGO_PORT")
+            logger.error("- SOURCE_MONGO_USER, SOURCE_MONGO_PASS")
+            logger.error("- SOURCE_MONGO_AUTHSOURCE")
+            logger.error("- SOURCE_MONGO_DIRECT_CONNECTION")
+            raise Exception("Cannot connect to source MongoDB")
+
+        if target_ok is not True:
             logger.error("Failed to connect to target MongoDB!")
             logger.error("Please check your .env file settings:")
             logger.error("- TARGET_MONGO_HOST, TARGET_MONGO_PORT")
@@ -77,33 +103,38 @@ class MigrationWorker:
         await self.target_store.initialize()
 
         # Создаем migrator
-        logger.info(f"Creating migrator with batch_size={settings.migration_batch_size}")
+        logger.info(f"Creating migrator with batch_size={self.batch_size}")
         self.migrator = ProductMigrator(
             self.source_store,
             self.target_store,
-            settings.migration_batch_size
+            self.batch_size,
+            redis_client=self.redis_client,
+            # Миграцию запускает сам воркер - будить остальных незачем
+            notify_workers=False
         )
 
     async def check_and_start_migration(self):
         """Проверить и начать миграцию если нужно"""
         logger.info("Checking migration status...")
 
-        # Проверяем, есть ли активные миграции
-        active_jobs = await self.target_store.migration_jobs.find({
-            "status": "running"
-        }).to_list(length=None)
+        # Активные и последняя завершенная миграции - одним запросом
+        jobs_overview = await self.target_store.get_migration_jobs_overview()
+
+        # Проверяем, есть ли активная миграция
+        job = jobs_overview["running"]
 
-        if active_jobs:
+        if job:
             # Есть активная миграция, продолжаем её
-            job = active_jobs[0]
             logger.info(f"Found active migration job: {job['job_id']}")
             logger.info(f"Progress: {job['migrated_products']}/{job['total_products']}")
 
             # Проверяем через Redis, обрабатывается ли она другим воркером
             if self.redis_client:
-                lock_key = f"migration_lock:{job['job_id']}"
                 lock_acquired = await self.redis_client.set(
-                    lock_key, "locked", nx=True, ex=300  # 5 минут TTL
+                    self._get_lock_key(job['job_id']),
+                    self.worker_id,
+                    nx=True,
+                    ex=MIGRATION_LOCK_TTL
                 )
 
                 if not lock_acquired:
@@ -113,21 +144,15 @@ class MigrationWorker:
             return job['job_id']
 
         # Проверяем, есть ли завершенные миграции
-        completed_jobs = await self.target_store.migration_jobs.find({
-            "status": "completed"
-        }).to_list(length=None)
-
-        if completed_jobs:
-            # Проверяем, есть ли новые товары для миграции
-            last_job = completed_jobs[-1]
-
-            # Считаем товары во всех коллекциях source
-            source_counts = await self.source_store.count_all_products()
+        if jobs_overview["last_completed"]:
+            # Проверяем, есть ли новые товары для миграции:
+            # считаем товары во всех коллекциях source и в target
+            source_counts, target_count = await asyncio.gather(
+                self.source_store.count_all_products(),
+                self.target_store.products.estimated_document_count()
+            )
             source_total = sum(source_counts.values())
 
-            # Считаем товары в target
-            target_count = await self.target_store.products.count_documents({})
-
             logger.info(f"Source products (all collections): {source_total}")
             logger.info(f"Target products: {target_count}")
 
@@ -158,41 +183,100 @@ class MigrationWorker:
         return await self.migrator.start_migration()
 
     async def monitor_migration(self, job_id: str):
-        """Мониторить прогресс миграции"""
+        """
+        Мониторить прогресс миграции
+
+        Мигратор публикует события прогресса в Redis, поэтому монитор ждет их,
+        а не опрашивает migration_jobs. Задача в MongoDB перечитывается только
+        если событий нет дольше интервала ожидания (например, миграцию
+        запустил процесс без Redis).
+        """
         last_progress = 0
+        last_lock_renew = time.monotonic()
 
-        while self.running:
+        # Подписываемся до чтения задачи, чтобы не пропустить события между ними
+        pubsub = None
+        if self.redis_client:
+            pubsub = self.redis_client.pubsub()
+            await pubsub.subscribe(get_migration_channel(job_id))
+
+        # Без Redis остаемся на частом опросе, с Redis - только страховочная проверка
+        wait_timeout = 30 if pubsub else 5
+
+        try:
             job = await self.target_store.get_migration_job(job_id)
 
             if not job:
                 logger.error(f"Migration job {job_id} not found!")
-                break
+                return
 
-            if job["status"] == "completed":
-                logger.info(f"Migration {job_id} completed successfully!")
-                logger.info(f"Total migrated: {job['migrated_products']} products")
-                break
+            total_products = job['total_products']
+
+            while self.running:
+                if job["status"] == "completed":
+                    logger.info(f"Migration {job_id} completed successfully!")
+                    logger.info(f"Total migrated: {job['migrated_products']} products")
+                    break
+
+                if job["status"] == "failed":
+                    logger.error(f"Migration {job_id} failed!")
+                    break
+
+                # Показываем прогресс
+                current_progress = job['migrated_products']
+                if current_progress != last_progress:
+                    percentage = (current_progress / total_products * 100) if total_products > 0 else 0
+                    logger.info(
+                        "Migration progress: %d/%d (%.1f%%)",
+                        current_progress, total_products, percentage
+                    )
+                    last_progress = current_progress
+
+                # Продлеваем блокировку в Redis, если она наша
+                if self.redis_client and time.monotonic() - last_lock_renew >= MIGRATION_LOCK_RENEW_INTERVAL:
+                    await self._renew_lock(
+                        keys=[self._get_lock_key(job_id)],
+                        args=[self.worker_id, MIGRATION_LOCK_TTL]
+                    )
+                    last_lock_renew = time.monotonic()
+
+                event = await self._wait_migration_event(pubsub, wait_timeout)
+
+                if event is not None:
+                    job = {**job, **event}
+                else:
+                    job = await self.target_store.get_migration_job(job_id)
+                    if not job:
+                        logger.error(f"Migration job {job_id} not found!")
+                        break
+        finally:
+            if pubsub:
+                await pubsub.unsubscribe()
+                await pubsub.close()
+
+    @staticmethod
+    def _get_lock_key(job_id: str) -> str:
+        return f"migration_lock:{job_id}"
+
+    async def _wait_migration_event(self, pubsub, timeout: float) -> Optional[Dict[str, Any]]:
+        """Дождаться события прогресса миграции; None - событий не было"""
+        if pubsub is None:
+            await asyncio.sleep(timeout)
+            return None
 
-            if job["status"] == "failed":
-                logger.error(f"Migration {job_id} failed!")
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        while self.running:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
                 break
 
-            # Показываем прогресс
-            current_progress = job['migrated_products']
-            if current_progress != last_progress:
-                percentage = (current_progress / job['total_products'] * 100) if job['total_products'] > 0 else 0
-                logger.info(
-                    f"Migration progress: {current_progress}/{job['total_products']} "
-                    f"({percentage:.1f}%)"
-                )
-                last_progress = current_progress
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+            if message and message["type"] == "message":
+                return json.loads(message["data"])
 
-            # Обновляем блокировку в Redis
-            if self.redis_client:
-                lock_key = f"migration_lock:{job_id}"
-                await self.redis_client.expire(lock_key, 300)  # Продлеваем на 5 минут
-
-            await asyncio.sleep(5)
+        return None
 
     async def start(self, job_id: Optional[str] = None):
         """Запустить воркер"""
@@ -203,8 +287,14 @@ class MigrationWorker:
         try:
             # Инициализируем Redis для координации
             try:
-                self.redis_client = await Redis.from_url(settings.redis_url)
+                # Общий пул: параллельные публикации и pub/sub не ждут одно соединение
+                self.redis_pool = BlockingConnectionPool.from_url(
+                    settings.redis_url,
+                    max_connections=settings.redis_max_connections
+                )
+                self.redis_client = Redis(connection_pool=self.redis_pool)
                 await self.redis_client.ping()
+                self._renew_lock = self.redis_client.register_script(RENEW_LOCK_SCRIPT)
                 logger.info("Connected to Redis for coordination")
             except Exception as e:
                 logger.warning(f"Redis not available: {e}")
@@ -222,12 +312,13 @@ class MigrationWorker:
             # ВАЖНО: Инициализируем stores ДО их использования
             await self.initialize_stores()
 
-            # Получаем список коллекций
-            collections = await self.source_store.get_collections_list()
+            # Получаем список коллекций и количество товаров
+            collections, source_counts = await asyncio.gather(
+                self.source_store.get_collections_list(),
+                self.source_store.count_all_products()
+            )
             logger.info(f"Found {len(collections)} product collections: {collections}")
 
-            # Проверяем количество товаров
-            source_counts = await self.source_store.count_all_products()
             total_count = sum(source_counts.values())
 
             logger.info(f"Total products across all collections: {total_count}")
@@ -258,9 +349,21 @@ class MigrationWorker:
 
                     # Ждем новые задачи
                     logger.info("Waiting for new migration tasks...")
+                    self._watch_tasks.append(asyncio.create_task(self._watch_jobs()))
+                    if self.redis_client:
+                        self._watch_tasks.append(asyncio.create_task(self._watch_task_queue()))
+
                     while self.running:
-                        # Периодически проверяем, не появились ли новые товары
-                        await asyncio.sleep(60)  # Проверка раз в минуту
+                        # Проверяем при изменении задач миграции, но не реже раза в минуту
+                        try:
+                            await asyncio.wait_for(self._wake.wait(), timeout=60)
+                        except asyncio.TimeoutError:
+                            pass
+                        finally:
+                            self._wake.clear()
+
+                        if not self.running:
+                            break
 
                         auto_job_id = await self.check_and_start_migration()
                         if auto_job_id:
@@ -275,14 +378,56 @@ class MigrationWorker:
         finally:
             await self.stop()
 
+    async def _watch_jobs(self):
+        """Будить цикл ожидания при создании задач миграции и смене их статуса"""
+        # Запись прогресса (несколько раз в секунду) не меняет status и не будит воркеров
+        pipeline = [{"$match": {"$or": [
+            {"operationType": "insert"},
+            {
+                "operationType": "update",
+                "updateDescription.updatedFields.status": {"$exists": True}
+            }
+        ]}}]
+
+        try:
+            async with self.target_store.migration_jobs.watch(pipeline) as stream:
+                async for _ in stream:
+                    self._wake.set()
+        except PyMongoError as e:
+            # Change streams доступны только на replica set - остаемся на периодической проверке
+            logger.warning(f"Migration jobs change stream unavailable, using periodic checks: {e}")
+
+    async def _watch_task_queue(self):
+        """Будить цикл ожидания по уведомлениям о новых задачах из Redis"""
+        while self.running:
+            try:
+                item = await self.redis_client.blpop(MIGRATION_TASKS_QUEUE, timeout=30)
+            except Exception as e:
+                logger.warning(f"Failed to read migration tasks queue: {e}")
+                await asyncio.sleep(5)
+                continue
+
+            if item:
+                self._wake.set()
+
     async def stop(self):
         """Остановить воркер"""
         logger.info("Stopping migration worker...")
         self.running = False
+        self._wake.set()
+
+        for task in self._watch_tasks:
+            task.cancel()
+        if self._watch_tasks:
+            await asyncio.gather(*self._watch_tasks, return_exceptions=True)
+            self._watch_tasks = []
 
         if self.redis_client:
             await self.redis_client.close()
 
+        if self.redis_pool:
+            await self.redis_pool.disconnect()
+
         if self.source_store:
             await self.source_store.close()
 
@@ -294,23 +439,21 @@ class MigrationWorker:
 
 async def main():
     """Запуск воркера из командной строки"""
-    import argparse
-
-    parser = argparse.ArgumentParser(description='Migration worker')
-    parser.add_argument('--job-id', help='Resume specific job')
-    parser.add_argument('--log-level', default='INFO',
-                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
-                        help='Logging level')
-    args = parser.parse_args()
-
-    # Настройка уровня логирования
-    log_level = getattr(logging, args.log_level.upper())
-    logging.getLogger().setLevel(log_level)
-    logging.getLogger('src').setLevel(log_level)
-
-    worker = MigrationWorker()
-    await worker.start(args.job_id)
+    cfg = WorkerConfig.parse(
+        'Migration worker',
+        default_worker_id=f"migration_worker_{uuid.uuid4().hex[:8]}",
+        default_batch_size=settings.migration_batch_size,
+        with_job_id=True
+    )
+    cfg.apply_log_level()
+    install_shutdown_handlers()
+
+    worker = MigrationWorker(cfg.worker_id, batch_size=cfg.batch_size)
+    try:
+        await worker.start(cfg.job_id)
+    except asyncio.CancelledError:
+        logger.info("Shutdown requested by user")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())